@@ -1,10 +1,24 @@
+import threading
 import agentscope
 from agentscope.agents import ReActAgentV2
 from agentscope.message import Msg
 from agentscope.service import ServiceToolkit
-    
 
-def RoutingAgent(api_key=None):
+_init_lock = threading.Lock()
+_initialized = False
+
+
+# agentscope.init 只执行一次，之后创建的 RoutingAgent 共用同一份模型配置
+def init_routing_model(api_key=None):
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        _init_model(api_key)
+        _initialized = True
+
+
+def _init_model(api_key):
     agentscope.init(
         model_configs=[
         {
@@ -16,6 +30,11 @@ def RoutingAgent(api_key=None):
             "generate_args": {"temperature": 0,},
         },],
     )
+
+
+# 每次返回新的agent（agent带有记忆，不能在任务间共享），模型只初始化一次
+def RoutingAgent(api_key=None):
+    init_routing_model(api_key)
     ReAct_Agent = ReActAgentV2(
         name="meta",
         model_config_name="openAI",
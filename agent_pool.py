@@ -0,0 +1,193 @@
+from collections import OrderedDict
+
+
+class AgentPool:
+    def __init__(self):
+        """
+        子智能体池：注册信息 + 按能力索引的空闲队列。
+        每个能力的空闲队列是一个 OrderedDict（按空闲先后排序），取用从队头、归还到队尾，
+        既能 O(1) 删除任意agent，又保证同一能力下各agent轮流分配。
+        """
+        self.agents = dict()   # agent_id -> {"capabilities", "listen_channel", "status"}
+        self.idle = dict()     # capability -> OrderedDict[agent_id, None]
+
+    def register(self, agent_id, capabilities, listen_channel, status="idle"):
+        """
+        新增或更新agent，重复注册时先撤掉旧能力下的空闲记录
+        :param capabilities:   能力列表或逗号分隔的字符串
+        """
+        if isinstance(capabilities, str):
+            capabilities = capabilities.split(",")
+        capabilities = [cap.strip() for cap in capabilities]
+        self._drop_idle(agent_id)
+        self.agents[agent_id] = {
+            "capabilities": capabilities,
+            "listen_channel": listen_channel,
+            "status": status
+        }
+        for cap in capabilities:
+            self.idle.setdefault(cap, OrderedDict())
+        if status == "idle":
+            self._push_idle(agent_id)
+
+    def unregister(self, agent_id):
+        """
+        注销agent，返回其注册信息（不存在时返回None）
+        """
+        self._drop_idle(agent_id)
+        return self.agents.pop(agent_id, None)
+
+    def acquire(self, capability):
+        """
+        取出该能力下空闲最久的agent并置为busy，没有空闲agent时返回None
+        """
+        queue = self.idle.get(capability)
+        if not queue:
+            return None
+        agent_id, _ = queue.popitem(last=False)
+        self._drop_idle(agent_id)
+        self.agents[agent_id]["status"] = "busy"
+        return agent_id
+
+    def release(self, agent_id):
+        """
+        agent完成任务后归还到其所有能力的空闲队列队尾，返回是否发生了状态变化
+        """
+        info = self.agents.get(agent_id)
+        if info is None or info["status"] == "idle":
+            return False
+        info["status"] = "idle"
+        self._push_idle(agent_id)
+        return True
+
+    def has_idle(self, capability):
+        return bool(self.idle.get(capability))
+
+    def get(self, agent_id, default=None):
+        return self.agents.get(agent_id, default)
+
+    def items(self):
+        return self.agents.items()
+
+    def __contains__(self, agent_id):
+        return agent_id in self.agents
+
+    def __len__(self):
+        return len(self.agents)
+
+    def _push_idle(self, agent_id):
+        for cap in self.agents[agent_id]["capabilities"]:
+            self.idle[cap][agent_id] = None
+
+    def _drop_idle(self, agent_id):
+        info = self.agents.get(agent_id)
+        if info is None:
+            return
+        for cap in info["capabilities"]:
+            self.idle[cap].pop(agent_id, None)
+
+
+class AgentStateTable:
+    def __init__(self):
+        """
+        精确的agent忙/闲状态表：agent_id 驻留为连续编号，忙闲状态存于按编号索引的 bytearray，
+        每个能力维护一个空闲位图（Python int），查询“某能力有无空闲agent”只需取最低置位。
+        """
+        self.numbers = dict()       # agent_id -> 编号
+        self.names = []             # 编号 -> agent_id（已注销的为None）
+        self.busy = bytearray()     # 编号 -> 1忙 / 0闲
+        self.capabilities = []      # 编号 -> 能力元组
+        self.idle_bits = dict()     # capability -> 空闲位图
+        self.free_numbers = []      # 注销后可复用的编号
+
+    def register(self, agent_id, capabilities=(), busy=None):
+        """
+        驻留agent并设置其能力，重复注册时更新能力、保留编号
+        :param capabilities:   能力列表或逗号分隔的字符串
+        :param busy:           初始忙闲状态，None 表示新agent为空闲、已注册的保持原状态
+        """
+        if isinstance(capabilities, str):
+            capabilities = capabilities.split(",")
+        capabilities = tuple(cap.strip() for cap in capabilities)
+        number = self.numbers.get(agent_id)
+        if busy is None:
+            busy = number is not None and self.busy[number] == 1
+        if number is None:
+            number = self.free_numbers.pop() if self.free_numbers else len(self.names)
+            if number == len(self.names):
+                self.names.append(None)
+                self.busy.append(0)
+                self.capabilities.append(())
+            self.numbers[agent_id] = number
+            self.names[number] = agent_id
+        else:
+            self._set_idle_bit(number, False)
+        self.capabilities[number] = capabilities
+        self.busy[number] = 1 if busy else 0
+        self._set_idle_bit(number, not busy)
+        return number
+
+    def unregister(self, agent_id):
+        number = self.numbers.pop(agent_id, None)
+        if number is None:
+            return False
+        self._set_idle_bit(number, False)
+        self.names[number] = None
+        self.busy[number] = 0
+        self.capabilities[number] = ()
+        self.free_numbers.append(number)
+        return True
+
+    def mark_busy(self, agent_id):
+        """
+        置为忙碌，未注册的agent会先以无能力身份驻留；返回是否发生了状态变化
+        """
+        number = self.numbers.get(agent_id)
+        if number is None:
+            number = self.register(agent_id)
+        if self.busy[number]:
+            return False
+        self.busy[number] = 1
+        self._set_idle_bit(number, False)
+        return True
+
+    def mark_idle(self, agent_id):
+        """
+        置为空闲，返回是否发生了状态变化
+        """
+        number = self.numbers.get(agent_id)
+        if number is None or not self.busy[number]:
+            return False
+        self.busy[number] = 0
+        self._set_idle_bit(number, True)
+        return True
+
+    def is_busy(self, agent_id):
+        number = self.numbers.get(agent_id)
+        return number is not None and self.busy[number] == 1
+
+    def any_idle(self, capability):
+        """
+        返回该能力下编号最小的空闲agent，没有时返回None
+        """
+        bits = self.idle_bits.get(capability, 0)
+        if not bits:
+            return None
+        return self.names[(bits & -bits).bit_length() - 1]
+
+    def idle_count(self, capability):
+        return bin(self.idle_bits.get(capability, 0)).count("1")
+
+    def __contains__(self, agent_id):
+        return agent_id in self.numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def _set_idle_bit(self, number, idle):
+        mask = 1 << number
+        for cap in self.capabilities[number]:
+            if idle:
+                self.idle_bits[cap] = self.idle_bits.get(cap, 0) | mask
+            elif cap in self.idle_bits:
+                self.idle_bits[cap] &= ~mask
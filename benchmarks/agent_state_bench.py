@@ -0,0 +1,98 @@
+# 对比 Cuckoo Filter（test1/test2 旧的忙碌agent记录）与 AgentStateTable：
+# 假跳过（空闲agent被判为忙碌）次数、误删导致的漏判，以及“为某能力找一个空闲agent”的耗时
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cuckoopy import CuckooFilter
+from agent_pool import AgentStateTable
+
+ABILITIES = ["text generation", "mathematical reasoning", "grammar polish", "analysis and summary"]
+AGENT_COUNTS = [50, 200, 800]
+BUSY_RATIO = 0.5
+ROUNDS = 2000
+SEED = 7
+
+
+def make_agents(n):
+    rng = random.Random(SEED)
+    return {f"agent-{i}": rng.sample(ABILITIES, rng.randint(1, 2)) for i in range(n)}
+
+
+def run_cuckoo(agents, schedule):
+    sketch = CuckooFilter(capacity=1000, bucket_size=4, fingerprint_size=1)
+    by_cap = {cap: [a for a, caps in agents.items() if cap in caps] for cap in ABILITIES}
+    busy = set()
+    false_skips = missed_busy = 0
+    elapsed = 0.0
+    for busy_now, idle_now, cap in schedule:
+        for agent_id in busy_now:
+            sketch.insert(agent_id)
+            busy.add(agent_id)
+        for agent_id in idle_now:
+            if sketch.contains(agent_id):
+                sketch.delete(agent_id)
+            busy.discard(agent_id)
+        start = time.perf_counter()
+        # 旧做法：逐个检查候选agent是否在过滤器中
+        found = next((a for a in by_cap[cap] if not sketch.contains(a)), None)
+        elapsed += time.perf_counter() - start
+        false_skips += sum(1 for a in by_cap[cap] if a not in busy and sketch.contains(a))
+        missed_busy += sum(1 for a in by_cap[cap] if a in busy and not sketch.contains(a))
+    return false_skips, missed_busy, elapsed
+
+
+def run_table(agents, schedule):
+    table = AgentStateTable()
+    for agent_id, caps in agents.items():
+        table.register(agent_id, caps)
+    by_cap = {cap: [a for a, caps in agents.items() if cap in caps] for cap in ABILITIES}
+    busy = set()
+    false_skips = missed_busy = 0
+    elapsed = 0.0
+    for busy_now, idle_now, cap in schedule:
+        for agent_id in busy_now:
+            table.mark_busy(agent_id)
+            busy.add(agent_id)
+        for agent_id in idle_now:
+            table.mark_idle(agent_id)
+            busy.discard(agent_id)
+        start = time.perf_counter()
+        found = table.any_idle(cap)
+        elapsed += time.perf_counter() - start
+        false_skips += sum(1 for a in by_cap[cap] if a not in busy and table.is_busy(a))
+        missed_busy += sum(1 for a in by_cap[cap] if a in busy and not table.is_busy(a))
+    return false_skips, missed_busy, elapsed
+
+
+def make_schedule(agents):
+    """每轮随机把一批空闲agent置忙、一批忙碌agent置闲，使忙碌比例在 BUSY_RATIO 附近波动。"""
+    rng = random.Random(SEED)
+    ids = list(agents)
+    busy = set()
+    schedule = []
+    for _ in range(ROUNDS):
+        idle = [a for a in ids if a not in busy]
+        want = int(len(ids) * BUSY_RATIO)
+        busy_now = rng.sample(idle, min(len(idle), max(1, want - len(busy) + 2)))
+        busy.update(busy_now)
+        idle_now = rng.sample(sorted(busy), min(len(busy), 2))
+        busy.difference_update(idle_now)
+        schedule.append((busy_now, idle_now, rng.choice(ABILITIES)))
+    return schedule
+
+
+def main():
+    print(f"{'agents':>7} {'impl':>8} {'false skips':>12} {'missed busy':>12} {'lookup us':>10}")
+    for n in AGENT_COUNTS:
+        agents = make_agents(n)
+        schedule = make_schedule(agents)
+        for label, run in (("cuckoo", run_cuckoo), ("table", run_table)):
+            false_skips, missed_busy, elapsed = run(agents, schedule)
+            print(f"{n:>7} {label:>8} {false_skips:>12} {missed_busy:>12} {elapsed / ROUNDS * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
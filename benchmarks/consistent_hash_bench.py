@@ -0,0 +1,50 @@
+# 对比虚拟节点环、Jump哈希、加权rendezvous哈希：查找吞吐、负载离散度（变异系数）、增删节点时的key搬动比例
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from consistent_hash import ConsistentHashing, JumpHashing, RendezvousHashing
+
+NODE_COUNTS = [8, 32, 128]
+NUM_KEYS = 50000
+
+IMPLEMENTATIONS = [
+    ("ring x10", lambda nodes: ConsistentHashing(nodes, replicas=10, cache_size=0)),
+    ("ring x100", lambda nodes: ConsistentHashing(nodes, replicas=100, cache_size=0)),
+    ("jump", lambda nodes: JumpHashing(nodes)),
+    ("rendezvous", lambda nodes: RendezvousHashing(nodes)),
+]
+
+
+def moved_fraction(before, after):
+    return sum(1 for a, b in zip(before, after) if a != b) / len(before)
+
+
+def main():
+    keys = [f"task-{i}" for i in range(NUM_KEYS)]
+    print(f"{'nodes':>6} {'impl':>11} {'lookups/s':>11} {'load CV':>8} {'add moved':>10} {'rm moved':>9} {'ideal':>6}")
+    for n in NODE_COUNTS:
+        nodes = [f"agent-{i}" for i in range(n)]
+        for label, make in IMPLEMENTATIONS:
+            ring = make(nodes)
+            start = time.perf_counter()
+            before = [ring.get_node(key) for key in keys]
+            rate = NUM_KEYS / (time.perf_counter() - start)
+            counts = [Counter(before).get(node, 0) for node in nodes]
+            cv = statistics.pstdev(counts) / statistics.mean(counts)
+
+            ring.add_node("agent-new")
+            added = [ring.get_node(key) for key in keys]
+            ring.remove_node("agent-new")
+            # 移除中间的节点（Jump哈希需要末尾节点补位，是它的不利情形）
+            ring.remove_node(nodes[n // 2])
+            removed = [ring.get_node(key) for key in keys]
+            print(f"{n:>6} {label:>11} {rate:>11.0f} {cv:>8.3f} {moved_fraction(before, added):>10.3f} "
+                  f"{moved_fraction(before, removed):>9.3f} {1 / n:>6.3f}")
+
+
+if __name__ == '__main__':
+    main()
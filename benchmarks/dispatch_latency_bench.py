@@ -0,0 +1,120 @@
+# 对比定时轮询与事件驱动两种调度循环的每阶段分发延迟（阶段就绪 -> 发布到agent）
+# 注册/结果消息走 communication.py 中真实的监听器，NATS 用进程内的假对象代替
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from agent_pool import AgentPool
+from communication import agent_registry_listener, result_listener
+
+ABILITIES = ["text generation", "mathematical reasoning", "grammar polish", "analysis and summary"]
+NUM_TASKS = 10
+STAGES = 3
+AGENTS_PER_ABILITY = 2
+SERVICE_TIME = 0.05
+POLL_INTERVALS = [1.0, 0.2]
+
+
+class FakeMsg:
+    def __init__(self, subject, body):
+        self.subject = subject
+        self.data = json.dumps(body).encode()
+
+    async def ack(self):
+        pass
+
+
+class FakeJetStream:
+    """收到子任务后等待 SERVICE_TIME，再以子智能体的身份把结果交给结果监听器。"""
+    def __init__(self, channel_to_agent):
+        self.channel_to_agent = channel_to_agent
+        self.handlers = {}
+        self.pending = set()
+
+    async def publish(self, subject, data):
+        task_id = json.loads(data)["payload"]["task_id"]
+        job = asyncio.ensure_future(self.complete(task_id, self.channel_to_agent[subject]))
+        self.pending.add(job)
+        job.add_done_callback(self.pending.discard)
+
+    async def complete(self, task_id, agent_id):
+        await asyncio.sleep(SERVICE_TIME)
+        body = {"header": {"type": "subtask-re"}, "payload": {"task_id": task_id, "agent_id": agent_id, "result": "ok"}}
+        await self.handlers[task_id](FakeMsg(f"{task_id}.result", body))
+
+
+def make_tasks():
+    # 每个任务是一条 STAGES 级的流水线
+    return [{"id": i, "subtasks": [{"task": f"t{i}-{s}", "ability": ABILITIES[(i + s) % len(ABILITIES)], "depends": [s - 1] if s else []}
+                                   for s in range(STAGES)],
+             "results": [None] * STAGES, "status": ["pending"] * STAGES, "remaining": STAGES, "finished": False, "ready_at": None}
+            for i in range(1, NUM_TASKS + 1)]
+
+
+async def run(poll_interval=None):
+    """poll_interval 为 None 时事件驱动，否则按该间隔轮询；返回(各阶段延迟列表, 总耗时)。"""
+    dispatch_event = asyncio.Event() if poll_interval is None else None
+    agent_pool, channel_to_agent, inflight = AgentPool(), {}, {}
+    js = FakeJetStream(channel_to_agent)
+    register = agent_registry_listener(agent_pool, js, dispatch_event)
+    for ability in ABILITIES:
+        for n in range(AGENTS_PER_ABILITY):
+            agent_id = f"{ability}-{n}"
+            channel_to_agent[f"agent.{agent_id}"] = agent_id
+            body = {"header": {"type": "register"}, "payload": {"agent_id": agent_id, "capabilities": ability,
+                                                                "listen_channel": f"agent.{agent_id}", "status": "idle"}}
+            await register(FakeMsg("meta.register", body))
+
+    TASKS = make_tasks()
+    start = time.perf_counter()
+    for task in TASKS:
+        task["ready_at"] = start
+        handler = result_listener({}, js, [task["id"]], TASKS, agent_pool, inflight, dispatch_event)
+
+        async def on_result(msg, handler=handler, task=task):
+            await handler(msg)
+            task["ready_at"] = time.perf_counter()
+        js.handlers[task["id"]] = on_result
+
+    latencies = []
+    if dispatch_event is not None:
+        dispatch_event.set()
+    while not all(t["finished"] for t in TASKS):
+        if dispatch_event is None:
+            await asyncio.sleep(poll_interval)
+        else:
+            await dispatch_event.wait()
+            dispatch_event.clear()
+        for task in TASKS:
+            for idx, subtask in enumerate(task["subtasks"]):
+                if task["status"][idx] != "pending" or any(task["status"][d] != "done" for d in subtask["depends"]):
+                    continue
+                agent_id = agent_pool.acquire(subtask["ability"])
+                if not agent_id:
+                    continue
+                task["status"][idx] = "running"
+                inflight[agent_id] = (task["id"], idx)
+                latencies.append(time.perf_counter() - task["ready_at"])
+                await js.publish(agent_pool.get(agent_id)["listen_channel"], json.dumps({"payload": {"task_id": task["id"]}}).encode())
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    print(f"{'mode':>12} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'makespan s':>11}")
+    modes = [("event", None)] + [(f"poll {interval}s", interval) for interval in POLL_INTERVALS]
+    for label, interval in modes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, makespan = asyncio.run(run(interval))
+        latencies_ms = sorted(x * 1e3 for x in latencies)
+        p95 = latencies_ms[int(len(latencies_ms) * 0.95) - 1]
+        print(f"{label:>12} {statistics.mean(latencies_ms):>9.2f} {p95:>9.2f} {latencies_ms[-1]:>9.2f} {makespan:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# 测量不同差异规模下 Decoder 的剥离耗时，并与旧的 list 队列实现对比
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from iblt import ContentSymbol, Encoder, Decoder, HashedSymbol
+
+DIFF_SIZES = [10, 100, 1000, 10000, 100000]
+# 旧实现是平方复杂度，超过该规模不再测
+LEGACY_MAX_DIFF = 10000
+
+
+class ListQueueDecoder(Decoder):
+    """旧实现：decodable 为 list，pop(0) 出队、线性扫描判重。"""
+    def __init__(self, hasher=None):
+        super().__init__(hasher)
+        self.decodable = []
+
+    def enqueue(self, cidx):
+        if cidx not in self.decodable:
+            self.decodable.append(cidx)
+
+    def try_decode(self):
+        while self.decodable:
+            cidx = self.decodable.pop(0)
+            c = self.cs[cidx]
+            if c.count == 1:
+                hs = HashedSymbol(c.symbol, self.hasher, c.hash)
+                m = self.apply_new_symbol(hs, -1)
+                self.remote.add_hashed_symbol_with_mapping(hs, m)
+                self.decoded_count += 1
+            elif c.count == -1:
+                hs = HashedSymbol(c.symbol, self.hasher, c.hash)
+                m = self.apply_new_symbol(hs, 1)
+                self.local.add_hashed_symbol_with_mapping(hs, m)
+                self.decoded_count += 1
+            elif c.count == 0:
+                self.decoded_count += 1
+
+
+def produce(diff):
+    # 对端为空集合，所有符号都是差异
+    encoder = Encoder()
+    for i in range(diff):
+        encoder.add_symbol(ContentSymbol(f"item-{i}"))
+    coded = []
+    decoder = Decoder()
+    # 先确定解码所需的编码符号数
+    while not (coded and decoder.decoded()):
+        cs = encoder.produce_next_coded_symbol()
+        coded.append(cs.copy())
+        decoder.add_coded_symbol(cs)
+        decoder.try_decode()
+    return coded
+
+
+def run(decoder_cls, coded):
+    decoder = decoder_cls()
+    start = time.perf_counter()
+    for cs in coded:
+        decoder.add_coded_symbol(cs.copy())
+    decoder.try_decode()
+    elapsed = time.perf_counter() - start
+    assert decoder.decoded()
+    return elapsed
+
+
+def main():
+    print(f"{'diff':>8} {'coded':>8} {'deque s':>10} {'us/coded':>9} {'list s':>10}")
+    for diff in DIFF_SIZES:
+        coded = produce(diff)
+        t_new = run(Decoder, coded)
+        t_old = f"{run(ListQueueDecoder, coded):>10.3f}" if diff <= LEGACY_MAX_DIFF else f"{'-':>10}"
+        print(f"{diff:>8} {len(coded):>8} {t_new:>10.3f} {t_new / len(coded) * 1e6:>9.1f} {t_old}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# 对比旧 JSON(+hex 信封) 格式与二进制线格式的载荷大小和编解码延迟
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from iblt import RatelessIBLTManager
+
+CONTEXT_SIZES = [10, 100, 1000]
+DOC_BYTES = 2048
+ROUNDS = 5
+
+
+def make_context(n):
+    return {f"doc_{i}": f"document {i} " + "x" * DOC_BYTES for i in range(n)}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / ROUNDS * 1e3
+
+
+def main():
+    print(f"{'docs':>6} {'format':>12} {'bytes':>12} {'ser ms':>9} {'deser ms':>9}")
+    for n in CONTEXT_SIZES:
+        context = make_context(n)
+        raw_bytes = sum(len(k) + len(v) for k, v in context.items())
+        for label, manager in (("binary", RatelessIBLTManager()), ("binary+zlib", RatelessIBLTManager(compress=True))):
+            coded = manager.deserialize_coded_symbols(manager.encode(context))
+            # 旧路径：JSON 载荷再 hex 进 JSON 信封（communication2 旧版 publish_subtask 的做法）
+            legacy, t_ser = timed(lambda: json.dumps({"iblt_data": manager.serialize_coded_symbols_json(coded).encode('utf-8').hex()}))
+            _, t_deser = timed(lambda: manager.deserialize_coded_symbols(bytes.fromhex(json.loads(legacy)["iblt_data"]).decode('utf-8')))
+            if label == "binary":
+                print(f"{n:>6} {'json+hex':>12} {len(legacy):>12} {t_ser:>9.2f} {t_deser:>9.2f}")
+            payload, t_ser = timed(manager.serialize_coded_symbols, coded)
+            _, t_deser = timed(manager.deserialize_coded_symbols, memoryview(payload))
+            print(f"{n:>6} {label:>12} {len(payload):>12} {t_ser:>9.2f} {t_deser:>9.2f}")
+        print(f"{n:>6} {'(context)':>12} {raw_bytes:>12}")
+
+
+if __name__ == '__main__':
+    main()
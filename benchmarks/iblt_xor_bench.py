@@ -0,0 +1,56 @@
+# 对比旧的逐字节异或与新的整数累加器异或在不同符号大小下的吞吐
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from iblt import ContentSymbol, HashedSymbol, CodedSymbol
+
+SYMBOL_SIZES = [64, 256, 1024, 4096, 16384, 65536]
+SYMBOLS_PER_SIZE = 64
+
+
+# 旧实现：ljust 补齐 + 逐字节异或，每次生成新的字节串
+def legacy_xor(d1, d2):
+    len1, len2 = len(d1), len(d2)
+    if len1 < len2:
+        d1 = d1.ljust(len2, b'\0')
+    else:
+        d2 = d2.ljust(len1, b'\0')
+    return bytes(a ^ b for a, b in zip(d1, d2))
+
+
+def bench_legacy(payloads, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        acc = b''
+        for data in payloads:
+            acc = legacy_xor(acc, data)
+    return time.perf_counter() - start
+
+
+def bench_accumulator(payloads, rounds):
+    hashed = [HashedSymbol(ContentSymbol(data)) for data in payloads]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cs = CodedSymbol()
+        for hs in hashed:
+            cs.apply(hs, 1)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'size':>8} {'legacy MB/s':>14} {'accum MB/s':>14} {'speedup':>9}")
+    for size in SYMBOL_SIZES:
+        payloads = [os.urandom(size - i % 7) for i in range(SYMBOLS_PER_SIZE)]
+        total_bytes = sum(len(p) for p in payloads)
+        # 小符号多跑几轮，保证计时稳定
+        rounds = max(1, 2 ** 20 // total_bytes)
+        t_old = bench_legacy(payloads, rounds)
+        t_new = bench_accumulator(payloads, rounds)
+        mb = total_bytes * rounds / 1e6
+        print(f"{size:>8} {mb / t_old:>14.1f} {mb / t_new:>14.1f} {t_old / t_new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
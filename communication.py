@@ -12,8 +12,9 @@ META_REGISTER_CHANNEL = "meta.register"
 def get_task_result_channel(task_id):
     return f"{task_id}.result"
 
-# 监听子智能体注册/注销，动态维护注册表
-def agent_registry_listener(agent_registry, capability_queues, js):
+# 监听子智能体注册/注销，动态维护agent池（agent_pool.AgentPool）
+# dispatch_event 非空时，注册表变化后置位，唤醒等待中的调度器
+def agent_registry_listener(agent_pool, js, dispatch_event=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -24,42 +25,29 @@ def agent_registry_listener(agent_registry, capability_queues, js):
                 capabilities = payload["capabilities"]
                 listen_channel = payload["listen_channel"]
                 status = payload["status"]
-                # 先将agent_id从所有能力队列中移除
-                for cap, q in capability_queues.items():
-                    if agent_id in q:
-                        q.remove(agent_id)
-                # 再根据新能力分配
-                agent_registry[agent_id] = {
-                    "capabilities": capabilities.split(","),
-                    "listen_channel": listen_channel,
-                    "status": status
-                }
-                for cap in capabilities.split(","):
-                    cap = cap.strip()
-                    if cap not in capability_queues:
-                        capability_queues[cap] = []
-                    if agent_id not in capability_queues[cap]:
-                        capability_queues[cap].append(agent_id)
+                # 重复注册时池内会先撤掉旧能力下的空闲记录
+                agent_pool.register(agent_id, capabilities, listen_channel, status)
                 print(f"[注册表] 新增/更新: {agent_id} 能力: {capabilities}")
                 logging.info(f"[注册] 新增/更新: {agent_id} 能力: {capabilities}")
             elif msg_type == "unregister":
                 payload = data["payload"]
                 agent_id = payload["agent_id"]
-                if agent_id in agent_registry:
-                    del agent_registry[agent_id]
-                for cap, q in capability_queues.items():
-                    if agent_id in q:
-                        q.remove(agent_id)
+                agent_pool.unregister(agent_id)
                 print(f"[注册表] 注销: {agent_id}")
                 logging.info(f"[注册] 注销： {agent_id} ")
         except Exception as e:
             print(f"[注册表] 处理消息异常: {e}")
             logging.info(f"[注册] 处理消息异常: {e}")
+        # 注册表变化（新的空闲agent或能力）后唤醒调度器
+        if dispatch_event is not None:
+            dispatch_event.set()
         await msg.ack()
     return message_handler
 
-# 监听子任务结果
-def result_listener(result_dict, js, task_ids, TASKS, agent_registry):
+# 监听子任务结果，inflight 为 agent_id -> (任务id, 子任务下标) 的在途表，由调度器在分发时写入，
+# 只接受与在途记录一致的结果（payload 带 subtask_idx 时同时核对下标）
+# dispatch_event 非空时，收到结果后置位，唤醒等待中的调度器
+def result_listener(result_dict, js, task_ids, TASKS, agent_pool, inflight, dispatch_event=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -75,27 +63,46 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry):
                     task_id = payload.get("task_id")
                 agent_id = payload.get("agent_id")
                 result = payload.get("result")
+                # 按在途表定位结果所属的子任务：agent不在在途表中、或任务/子任务下标与在途记录不符的
+                # 是重复投递或过期的结果，直接丢弃，不猜测归属
+                expected = inflight.get(agent_id)
+                reported_idx = payload.get("subtask_idx")
+                if expected is None or expected[0] != task_id or (reported_idx is not None and reported_idx != expected[1]):
+                    print(f"[结果] 丢弃任务{task_id}来自{agent_id}的结果：不是其在途子任务 {expected}")
+                    logging.warning(f"[结果] 丢弃任务{task_id}来自{agent_id}的结果：不是其在途子任务 {expected}")
+                    # 在途表中没有该agent时，它不可能还在执行子任务，复位以免一直处于busy
+                    if expected is None and agent_id and agent_pool.release(agent_id):
+                        print(f"[状态] agent {agent_id} 置为idle")
+                        logging.info(f"[状态] agent {agent_id} 置为idle")
+                        if dispatch_event is not None:
+                            dispatch_event.set()
+                    await msg.ack()
+                    return
+                task_id, idx = inflight.pop(agent_id)
                 # 找到对应task
                 task = next((t for t in TASKS if t["id"] == task_id), None)
-                if task is not None:
+                if task is not None and task["status"][idx] == "running":
                     if isinstance(result, list):
                         result = "\n".join(str(x) for x in result)
                     else:
                         result = str(result)
-                    task["results"].append(result)
-                    task["current_stage"] += 1
-                    print(f"[结果] 任务{task_id} 阶段{task['current_stage']-1} 结果: {result}")
-                    logging.info(f"[结果] 任务{task_id} 阶段{task['current_stage']-1} 结果: {result}")
+                    task["results"][idx] = result
+                    task["status"][idx] = "done"
+                    task["remaining"] -= 1
+                    print(f"[结果] 任务{task_id} 子任务{idx} 结果: {result}")
+                    logging.info(f"[结果] 任务{task_id} 子任务{idx} 结果: {result}")
                     # 复位agent
-                    if agent_id and agent_id in agent_registry:
-                        agent_registry[agent_id]["status"] = "idle"
+                    if agent_id and agent_pool.release(agent_id):
                         print(f"[状态] agent {agent_id} 置为idle")
                         logging.info(f"[状态] agent {agent_id} 置为idle")
                     # 判断是否完成
-                    if task["current_stage"] >= len(task["subtasks"]):
+                    if task["remaining"] == 0:
                         task["finished"] = True
                         print(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
                         logging.info(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
+                    # 子任务完成、agent复位后唤醒调度器
+                    if dispatch_event is not None:
+                        dispatch_event.set()
             await msg.ack()
         except Exception as e:
             print(f"[结果监听] 处理消息异常: {e}")
@@ -103,7 +110,8 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry):
     return message_handler
 
 # 发布任务到指定子智能体频道
-async def publish_subtask(js, listen_channel, task_id, query):
+# subtask_idx 非空时随消息下发，子智能体在结果payload中原样带回，用于核对在途表
+async def publish_subtask(js, listen_channel, task_id, query, subtask_idx=None):
     msg = {
         "header": {
             "type": "subtask",
@@ -114,5 +122,7 @@ async def publish_subtask(js, listen_channel, task_id, query):
             "query": query  
         }
     }
+    if subtask_idx is not None:
+        msg["payload"]["subtask_idx"] = subtask_idx
     await js.publish(listen_channel, json.dumps(msg).encode())
     print(f"[分发] 已发布任务{task_id}到{listen_channel}")
\ No newline at end of file
@@ -13,8 +13,16 @@ META_REGISTER_CHANNEL = "meta.register"
 def get_task_result_channel(task_id):
     return f"{task_id}.result"
 
+# agent在环上的基础虚拟节点数：能力越多，虚拟节点越少
+def base_vnodes(capabilities):
+    return max(1, 10 - len(capabilities))
+
 # 监听子智能体注册/注销，动态维护注册表和一致性哈希环
-def agent_registry_listener(agent_registry, capability_rings, js):
+# dispatch_event 非空时，注册表变化后置位，唤醒等待中的调度器
+# agent_states 非空时同步维护 agent_pool.AgentStateTable（驻留编号和能力）
+# ring_factory(capability) 非空时用它为新能力创建路由结构（见 consistent_hash.RING_TYPES），默认虚拟节点环
+# tracker 非空时，agent注销后丢弃其吞吐测量（consistent_hash.ThroughputTracker）
+def agent_registry_listener(agent_registry, capability_rings, js, dispatch_event=None, agent_states=None, ring_factory=None, tracker=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -27,6 +35,14 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                 listen_channel = payload["listen_channel"]
                 status = payload["status"]
 
+                # 重复注册时，从不再具备的能力的环上移除
+                previous = agent_registry.get(agent_id)
+                if previous is not None:
+                    dropped = {cap.strip() for cap in previous["capabilities"]} - {cap.strip() for cap in capabilities}
+                    for cap in dropped:
+                        if cap in capability_rings:
+                            capability_rings[cap].remove_node(agent_id)
+
                 # 更新注册表
                 agent_registry[agent_id] = {
                     "capabilities": capabilities,
@@ -36,10 +52,14 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                 for cap in capabilities:
                     cap = cap.strip()
                     if cap not in capability_rings:
-                        capability_rings[cap] = ConsistentHashing()
-                    # 根据agent能力数量调整虚拟节点数，能力越多，虚拟节点越少
-                    vnodes = max(1, 10 - len(capabilities))
-                    capability_rings[cap].add_node(agent_id, replicas=vnodes)
+                        capability_rings[cap] = ring_factory(cap) if ring_factory else ConsistentHashing()
+                    # 已在环上的agent保留按吞吐调整过的权重，只有新加入的才按能力数量设置虚拟节点数
+                    if capability_rings[cap].weight(agent_id) is None:
+                        # 根据agent能力数量调整虚拟节点数，能力越多，虚拟节点越少
+                        vnodes = base_vnodes(capabilities)
+                        capability_rings[cap].add_node(agent_id, replicas=vnodes)
+                if agent_states is not None:
+                    agent_states.register(agent_id, capabilities)
                 print(f"[注册] : {capability_rings[cap]}")  
                 print(f"[注册表] 新增/更新: {agent_id} 能力: {capabilities}")
                 # 更新一致性哈希环
@@ -50,20 +70,31 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                 if agent_id in agent_registry:
                     # 从所有相关的哈希环中移除节点
                     for cap in agent_registry[agent_id]["capabilities"]:
+                        cap = cap.strip()
                         if cap in capability_rings:
                             capability_rings[cap].remove_node(agent_id)
                     del agent_registry[agent_id]
+                if agent_states is not None:
+                    agent_states.unregister(agent_id)
+                if tracker is not None:
+                    tracker.forget(agent_id)
                 print(f"[注册表] 注销: {agent_id}")
                 logging.info(f"[注册] 注销： {agent_id}")
 
         except Exception as e:
             print(f"[注册表] 处理消息异常: {e}")
             logging.info(f"[注册] 处理消息异常: {e}")
+        # 注册表变化（新的空闲agent或能力）后唤醒调度器
+        if dispatch_event is not None:
+            dispatch_event.set()
         await msg.ack()
     return message_handler
 
 # 监听子任务结果
-def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent_sketch):
+# dispatch_event 非空时，收到结果后置位，唤醒等待中的调度器
+# capability_rings 非空时，释放agent在哈希环上的在途计数（有界负载）
+# tracker 非空时记录agent完成时间，用于按吞吐调整权重（consistent_hash.ThroughputTracker）
+def result_listener(result_dict, js, task_ids, TASKS, agent_registry, agent_states, dispatch_event=None, capability_rings=None, tracker=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -91,8 +122,13 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent
                     print(f"[结果] 任务{task_id} 阶段{task['current_stage']} 结果: {result}")
                     logging.info(f"[结果] 任务{task_id} 阶段{task['current_stage']} 结果: {result}")
                     # 复位agent
-                    if agent_id and busy_agent_sketch.contains(agent_id):
-                        busy_agent_sketch.delete(agent_id)
+                    if tracker is not None and agent_id:
+                        tracker.on_complete(agent_id)
+                    if capability_rings is not None and agent_id in agent_registry:
+                        for cap in agent_registry[agent_id]["capabilities"]:
+                            if cap.strip() in capability_rings:
+                                capability_rings[cap.strip()].release(agent_id)
+                    if agent_id and agent_states.mark_idle(agent_id):
                         print(f"[状态] agent {agent_id} 置为idle")
                         logging.info(f"[状态] agent {agent_id} 置为idle")
                     # 判断是否完成
@@ -100,6 +136,9 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent
                         task["finished"] = True
                         print(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
                         logging.info(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
+                    # 阶段推进、agent复位后唤醒调度器
+                    if dispatch_event is not None:
+                        dispatch_event.set()
             await msg.ack()
         except Exception as e:
             print(f"[结果监听] 处理消息异常: {e}")
@@ -1,4 +1,5 @@
 import asyncio
+import base64
 import json
 import time
 from nats.aio.client import Client as NATS
@@ -6,15 +7,33 @@ from nats.js.api import StreamConfig
 import re
 import logging
 from consistent_hash import ConsistentHashing
+from iblt import StrataEstimator
 
 META_REGISTER_CHANNEL = "meta.register"
 
+# 子任务消息的 NATS 头：消息体为 JSON 信封 + IBLT 二进制载荷，
+# 该头记录 JSON 信封的字节长度，IBLT 载荷紧随其后，不再做 hex/JSON 二次包装
+IBLT_OFFSET_HEADER = "Iblt-Offset"
+
+# 子智能体解码不成功时，通过该频道(request/reply)向meta端拉取更多编码符号
+IBLT_MORE_CHANNEL = "meta.iblt.more"
+
+# 共享编码符号流所在的JetStream流，同一上下文版本只发布一次，多个子智能体各自读取所需前缀
+IBLT_STREAM_NAME = "IBLT_SHARED"
+IBLT_STREAM_SUBJECTS = "iblt.stream.>"
+
+# 共享流续发请求的回复状态：已续发（或已发布足够），或主题已失效（上下文变化/会话已关闭），子智能体应放弃该流
+IBLT_STREAM_OK = b"ok"
+IBLT_STREAM_STALE = b"stale"
+
 # 获取子任务结果频道
 def get_task_result_channel(task_id):
     return f"{task_id}.result"
 
 # 监听子智能体注册/注销，动态维护注册表和一致性哈希环
-def agent_registry_listener(agent_registry, capability_rings, js):
+# dispatch_event 非空时，注册表变化后置位，唤醒等待中的调度器
+# agent_states 非空时同步维护 agent_pool.AgentStateTable（驻留编号和能力）
+def agent_registry_listener(agent_registry, capability_rings, js, dispatch_event=None, agent_states=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -31,7 +50,9 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                 agent_registry[agent_id] = {
                     "capabilities": capabilities,
                     "listen_channel": listen_channel,
-                    "status": status
+                    "status": status,
+                    # 子智能体公布的本地上下文分层估计器（base64），用来估计差异大小
+                    "strata": parse_strata_estimator(payload.get("strata"))
                 }
                 for cap in capabilities:
                     cap = cap.strip()
@@ -40,6 +61,8 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                     # 根据agent能力数量调整虚拟节点数，能力越多，虚拟节点越少
                     vnodes = max(1, 10 - len(capabilities))
                     capability_rings[cap].add_node(agent_id, replicas=vnodes)
+                if agent_states is not None:
+                    agent_states.register(agent_id, capabilities)
                 print(f"[注册] : {capability_rings[cap]}")  
                 print(f"[注册表] 新增/更新: {agent_id} 能力: {capabilities}")
                 # 更新一致性哈希环
@@ -53,17 +76,41 @@ def agent_registry_listener(agent_registry, capability_rings, js):
                         if cap in capability_rings:
                             capability_rings[cap].remove_node(agent_id)
                     del agent_registry[agent_id]
+                if agent_states is not None:
+                    agent_states.unregister(agent_id)
                 print(f"[注册表] 注销: {agent_id}")
                 logging.info(f"[注册] 注销： {agent_id}")
 
         except Exception as e:
             print(f"[注册表] 处理消息异常: {e}")
             logging.info(f"[注册] 处理消息异常: {e}")
+        # 注册表变化（新的空闲agent或能力）后唤醒调度器
+        if dispatch_event is not None:
+            dispatch_event.set()
         await msg.ack()
     return message_handler
 
+# 解析注册/心跳消息中的分层估计器，缺失或损坏时返回None
+def parse_strata_estimator(encoded):
+    if not encoded:
+        return None
+    try:
+        estimator = StrataEstimator.from_serialized(base64.b64decode(encoded))
+        # 参数与meta端不一致的估计器无法相减，当作未公布处理
+        if not estimator.compatible(StrataEstimator()):
+            raise ValueError("分层估计器参数与meta端不一致")
+        return estimator
+    except Exception as e:
+        logging.warning(f"[注册] 分层估计器解析失败: {e}")
+        return None
+
+# 子智能体侧：把本地上下文的分层估计器编码进注册/心跳消息的payload
+def encode_strata_estimator(local_context):
+    return base64.b64encode(StrataEstimator.from_context(local_context).serialize()).decode()
+
 # 监听子任务结果
-def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent_sketch):
+# dispatch_event 非空时，收到结果后置位，唤醒等待中的调度器
+def result_listener(result_dict, js, task_ids, TASKS, agent_registry, agent_states, dispatch_event=None):
     async def message_handler(msg):
         try:
             data = json.loads(msg.data.decode())
@@ -91,8 +138,7 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent
                     print(f"[结果] 任务{task_id} 阶段{task['current_stage']} 结果: {result}")
                     logging.info(f"[结果] 任务{task_id} 阶段{task['current_stage']} 结果: {result}")
                     # 复位agent
-                    if agent_id and busy_agent_sketch.contains(agent_id):
-                        busy_agent_sketch.delete(agent_id)
+                    if agent_id and agent_states.mark_idle(agent_id):
                         print(f"[状态] agent {agent_id} 置为idle")
                         logging.info(f"[状态] agent {agent_id} 置为idle")
                     # 判断是否完成
@@ -100,14 +146,114 @@ def result_listener(result_dict, js, task_ids, TASKS, agent_registry, busy_agent
                         task["finished"] = True
                         print(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
                         logging.info(f"[主控] 任务{task_id}已完成，结果: {task['results']}")
+                    # 阶段推进、agent复位后唤醒调度器
+                    if dispatch_event is not None:
+                        dispatch_event.set()
             await msg.ack()
         except Exception as e:
             print(f"[结果监听] 处理消息异常: {e}")
             logging.error(f"[结果监听] 处理消息异常: {e}")
     return message_handler
 
+# 响应子智能体拉取更多编码符号的请求，回复内容直接是IBLT二进制载荷
+# sketch_cache 非空时补发的载荷也经过缓存，重试拉取同一区间时直接复用；
+# 请求带 subject 时表示共享流读到了末尾，在共享流上续发下一批（需要js），
+# 回复 IBLT_STREAM_OK；主题已不是该上下文的当前主题或会话不存在时回复 IBLT_STREAM_STALE
+def iblt_more_listener(iblt_manager, sketch_cache=None, js=None):
+    async def message_handler(msg):
+        try:
+            data = json.loads(msg.data.decode())
+            context_id = data["context_id"]
+            if data.get("subject") is not None:
+                if js is not None and iblt_manager.get_session(context_id) is not None \
+                        and data["subject"] == iblt_manager.stream_subject(context_id):
+                    await publish_shared_stream(js, iblt_manager, context_id, int(data["start"]) + int(data["count"]))
+                    await msg.respond(IBLT_STREAM_OK)
+                else:
+                    await msg.respond(IBLT_STREAM_STALE)
+                return
+            start = int(data["start"])
+            count = int(data["count"])
+            session = iblt_manager.get_session(context_id)
+            # 上下文已变化时前缀无法继续拼接，回复空载荷让子智能体重新同步
+            if session is None or data.get("version", session.version) != session.version:
+                await msg.respond(b"")
+                return
+            if sketch_cache is not None:
+                payload = sketch_cache.encode_range(context_id, start, count)
+            else:
+                payload = iblt_manager.encode_range(context_id, start, count)
+            await msg.respond(payload)
+            logging.info(f"[IBLT] 上下文{context_id} 补发编码符号[{start}, {start + count})")
+        except Exception as e:
+            print(f"[IBLT] 处理拉取请求异常: {e}")
+            logging.error(f"[IBLT] 处理拉取请求异常: {e}")
+    return message_handler
+
+# 子智能体侧：向meta端拉取 [start, start+count) 的编码符号，返回二进制载荷（上下文不存在时为空）
+async def request_more_coded_symbols(nc, context_id, start, count, version=None, timeout=5):
+    request = {"context_id": context_id, "start": start, "count": count}
+    if version is not None:
+        request["version"] = version
+    reply = await nc.request(IBLT_MORE_CHANNEL, json.dumps(request).encode(), timeout=timeout)
+    return reply.data
+
+# meta侧：确保共享流上至少发布了前 upto 个编码符号，返回共享流主题
+async def publish_shared_stream(js, iblt_manager, context_id, upto):
+    subject, batches = iblt_manager.shared_batches(context_id, upto)
+    for end, payload in batches:
+        await js.publish(subject, payload)
+        # 发布成功后才记为已发布，失败时后续批次不会被跳过，下次请求从失败处重发
+        iblt_manager.mark_published(subject, end)
+    if batches:
+        logging.info(f"[IBLT] 共享流{subject} 新发布{len(batches)}批")
+    return subject
+
+# 子智能体侧：从共享流按顺序读取批次解码，读到末尾仍未完成时请求meta续发；
+# meta回复主题已失效，或连续 max_idle 次请求续发后仍读不到新批次时放弃，返回None
+async def reconcile_from_stream(js, nc, iblt_manager, local_context, payload, batch_size=32, timeout=2, max_symbols=100000, max_idle=5):
+    subject = payload["iblt_subject"]
+    decoder = iblt_manager.new_decoder(local_context)
+    sub = await js.subscribe(subject, ordered_consumer=True)
+    done = False
+    idle = 0
+    try:
+        while not done and decoder.next_start() < max_symbols:
+            try:
+                msg = await sub.next_msg(timeout=timeout)
+            except asyncio.TimeoutError:
+                idle += 1
+                if idle > max_idle:
+                    logging.warning(f"[IBLT] 共享流{subject} 连续{max_idle}次续发后无新批次，放弃")
+                    break
+                request = {"context_id": payload["iblt_context"], "subject": subject,
+                           "start": decoder.next_start(), "count": batch_size}
+                reply = await nc.request(IBLT_MORE_CHANNEL, json.dumps(request).encode(), timeout=timeout)
+                if reply.data == IBLT_STREAM_STALE:
+                    logging.info(f"[IBLT] 共享流{subject} 已失效，放弃")
+                    break
+                continue
+            idle = 0
+            done = await decoder.feed_async(msg.data)
+    finally:
+        await sub.unsubscribe()
+    return decoder.result() if done else None
+
+# 子智能体侧：用任务消息附带的前缀解码，不够时按批继续拉取，直到解码完成或meta端无更多数据
+async def reconcile_context(nc, iblt_manager, local_context, payload, iblt_data, batch_size=32, max_symbols=100000):
+    decoder = iblt_manager.new_decoder(local_context)
+    done = await decoder.feed_async(iblt_data) if iblt_data else False
+    context_id = payload.get("iblt_context")
+    version = payload.get("iblt_version")
+    while not done and context_id is not None and decoder.next_start() < max_symbols:
+        more = await request_more_coded_symbols(nc, context_id, decoder.next_start(), batch_size, version)
+        if not more:
+            break
+        done = await decoder.feed_async(more)
+    return decoder.result() if done else None
+
 # 发布任务到指定子智能体频道
-async def publish_subtask(js, listen_channel, task_id, query, iblt_data=None):
+async def publish_subtask(js, listen_channel, task_id, query, iblt_data=None, iblt_context=None, iblt_version=None, iblt_subject=None):
     msg = {
         "header": {
             "type": "subtask",
@@ -116,8 +262,21 @@ async def publish_subtask(js, listen_channel, task_id, query, iblt_data=None):
         "payload":{
             "task_id": task_id,
             "query": query,
-            "iblt_data": iblt_data.hex() if iblt_data else None # 将bytes转为hex字符串以便JSON序列化
+            "iblt_length": len(iblt_data) if iblt_data else 0,
+            "iblt_context": iblt_context, # 拉取更多编码符号时使用的上下文标识
+            "iblt_version": iblt_version, # 上下文版本，变化后旧前缀不再可拉取
+            "iblt_subject": iblt_subject # 共享编码符号流的主题（不随消息附带载荷时使用）
         }
     }
-    await js.publish(listen_channel, json.dumps(msg).encode())
+    envelope = json.dumps(msg).encode()
+    headers = {IBLT_OFFSET_HEADER: str(len(envelope))}
+    await js.publish(listen_channel, envelope + bytes(iblt_data or b""), headers=headers)
     print(f"[分发] 已发布任务{task_id}到{listen_channel}")
+
+# 解析子任务消息，返回 (JSON信封, IBLT载荷的memoryview或None)，载荷可直接交给 RatelessIBLTManager.decode
+def parse_subtask_message(msg):
+    view = memoryview(msg.data)
+    offset = int((msg.headers or {}).get(IBLT_OFFSET_HEADER, len(view)))
+    data = json.loads(bytes(view[:offset]).decode())
+    iblt_data = view[offset:] if offset < len(view) else None
+    return data, iblt_data
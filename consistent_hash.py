@@ -1,51 +1,194 @@
 import hashlib
 import bisect
+import heapq
+import math
+import time
+from array import array
+from collections import OrderedDict, deque
+import numpy as np
 
-class ConsistentHashing:
-    def __init__(self, nodes=None, replicas=10):
+def blake2b_64(key_str):
+    """
+    64位哈希：blake2b截取8字节摘要
+    """
+    return int.from_bytes(hashlib.blake2b(str(key_str).encode('utf-8'), digest_size=8).digest(), 'little')
+
+def md5_64(key_str):
+    """
+    64位哈希：md5摘要的前8字节
+    """
+    return int.from_bytes(hashlib.md5(str(key_str).encode('utf-8')).digest()[:8], 'little')
+
+HASH_FUNCTIONS = {
+    "blake2b-64": blake2b_64,
+    "md5-64": md5_64,
+}
+
+class BoundedLoad:
+    """
+    有界负载的公共部分：在途计数、容量上限，以及按子类给出的候选顺序挑选未超容量的节点。
+    子类实现 _candidates(key_str)，按偏好顺序逐个产出不重复的节点。
+    """
+    def __init__(self, load_factor=1.25):
+        self.load_factor = load_factor
+        self.loads = dict()     # node -> 在途数
+        self.total_load = 0
+
+    def capacity(self):
+        """
+        有界负载下单个节点当前允许的在途数上限
+        """
+        if not self.loads:
+            return 0
+        return math.ceil(self.load_factor * (self.total_load + 1) / len(self.loads))
+
+    def get_node_bounded(self, key_str, exclude=None):
+        """
+        按key_str的偏好顺序返回第一个在途数低于容量上限的节点，都不可用时返回None
+        :param exclude:       额外跳过节点的判定函数（如忙碌的agent），可为None
+        """
+        limit = self.capacity()
+        for node in self._candidates(key_str):
+            if self.loads.get(node, 0) < limit and not (exclude and exclude(node)):
+                return node
+        return None
+
+    def acquire(self, node):
+        """
+        记录node新增一个在途任务
+        """
+        if node in self.loads:
+            self.loads[node] += 1
+            self.total_load += 1
+
+    def release(self, node):
+        """
+        node完成一个在途任务，返回是否确有在途任务被释放
+        """
+        if self.loads.get(node, 0) > 0:
+            self.loads[node] -= 1
+            self.total_load -= 1
+            return True
+        return False
+
+    def _track(self, node):
+        self.loads.setdefault(node, 0)
+
+    def _untrack(self, node):
+        self.total_load -= self.loads.pop(node, 0)
+
+class ConsistentHashing(BoundedLoad):
+    def __init__(self, nodes=None, replicas=10, load_factor=1.25, hash_func="blake2b-64", cache_size=1024):
         """
         :param nodes:         初始节点
         :param replicas:      每个节点对应的虚拟节点数
+        :param load_factor:   有界负载的容量系数c，每个节点的在途数不超过 ceil(c * (总在途数+1) / 节点数)
+        :param hash_func:     64位哈希函数，HASH_FUNCTIONS中的名字或可调用对象
+        :param cache_size:    get_node 的 key->node LRU缓存大小，0表示不缓存；环成员变化后缓存失效
         """
+        super().__init__(load_factor)
         self.replicas = replicas
+        self.hash_func = HASH_FUNCTIONS[hash_func] if isinstance(hash_func, str) else hash_func
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_version = 0
+        self.version = 0            # 环成员版本，每次增删节点加一
         self.ring = dict()
-        self.sorted_keys = []
+        self.sorted_keys = array('Q')
+        self.node_keys = dict()     # node -> 该节点实际加入环的虚拟节点键
+        self.node_replicas = dict() # node -> 虚拟节点数（权重）
         if nodes:
-            for node in nodes:
-                self.add_node(node)
+            self.add_nodes(nodes)
 
     def add_node(self, node, replicas=None):
         """
-        添加node，同时根据replicas增加虚拟节点
+        添加node，同时根据replicas增加虚拟节点；node已存在时按新的replicas重建其虚拟节点
+        """
+        self.add_nodes([node], replicas)
+
+    def add_nodes(self, nodes, replicas=None):
+        """
+        批量添加node：先算出全部虚拟节点并排序，再与环上已有的有序键做一次归并
         """
         replicas = replicas if replicas is not None else self.replicas
-        for i in range(replicas):
-            virtual_node_key = f"{node}-{i}"
-            key = self._hash(virtual_node_key)
-            self.ring[key] = node
-            bisect.insort(self.sorted_keys, key)
+        # 去重（保持顺序），否则同一node的前一批虚拟节点会残留在环上
+        nodes = list(dict.fromkeys(nodes))
+        existing = [node for node in nodes if node in self.node_keys]
+        if existing:
+            self._drop_vnodes(existing)
+        new_keys = []
+        for node in nodes:
+            keys = []
+            for i in range(replicas):
+                virtual_node_key = f"{node}-{i}"
+                key = self._hash(virtual_node_key)
+                # 与已有虚拟节点哈希冲突时保留原归属，避免移除时误删别的节点
+                if key not in self.ring:
+                    self.ring[key] = node
+                    keys.append(key)
+            self.node_keys[node] = keys
+            self.node_replicas[node] = replicas
+            self._track(node)
+            new_keys.extend(keys)
+        new_keys.sort()
+        self.sorted_keys = array('Q', heapq.merge(self.sorted_keys, new_keys))
+        self.version += 1
 
     def remove_node(self, node):
         """
-        移除node，同时移除对应的虚拟节点
-        """
-        # 确定要移除的虚拟节点数量
-        # 由于我们无法直接知道添加时用了多少replicas，这里假设一个默认值或从外部传入
-        # 在实际应用中，最好在添加节点时记录其replicas数量
-        replicas_to_remove = self.replicas # 这是一个简化的假设
-        keys_to_remove = []
-        for i in range(replicas_to_remove):
-            virtual_node_key = f"{node}-{i}"
-            key = self._hash(virtual_node_key)
-            if key in self.ring and self.ring[key] == node:
-                keys_to_remove.append(key)
-        
-        for key in keys_to_remove:
-            del self.ring[key]
-            # 使用bisect.bisect_left和del来高效移除元素
-            idx = bisect.bisect_left(self.sorted_keys, key)
-            if idx < len(self.sorted_keys) and self.sorted_keys[idx] == key:
-                del self.sorted_keys[idx]
+        移除node，同时移除添加时实际加入的虚拟节点
+        """
+        if node not in self.node_keys:
+            return
+        self._drop_vnodes([node])
+        del self.node_keys[node]
+        del self.node_replicas[node]
+        self._untrack(node)
+
+    def weight(self, node):
+        return self.node_replicas.get(node)
+
+    def set_weight(self, node, replicas):
+        """
+        调整node的虚拟节点数：只增删编号在新旧数量之间的尾部虚拟节点，其余虚拟节点位置不变，
+        因此只有这些虚拟节点覆盖的key会搬动
+        """
+        old = self.node_replicas.get(node)
+        replicas = max(1, replicas)
+        if old is None or replicas == old:
+            return
+        if replicas > old:
+            new_keys = []
+            for i in range(old, replicas):
+                key = self._hash(f"{node}-{i}")
+                if key not in self.ring:
+                    self.ring[key] = node
+                    new_keys.append(key)
+            self.node_keys[node].extend(new_keys)
+            new_keys.sort()
+            self.sorted_keys = array('Q', heapq.merge(self.sorted_keys, new_keys))
+        else:
+            removed = {key for key in (self._hash(f"{node}-{i}") for i in range(replicas, old)) if self.ring.get(key) == node}
+            for key in removed:
+                del self.ring[key]
+            self.node_keys[node] = [key for key in self.node_keys[node] if key not in removed]
+            self.sorted_keys = array('Q', (key for key in self.sorted_keys if key not in removed))
+        self.node_replicas[node] = replicas
+        self.version += 1
+
+    def _drop_vnodes(self, nodes):
+        """
+        从环上删除nodes的全部虚拟节点，一次线性过滤重建有序键
+        """
+        removed = set()
+        for node in nodes:
+            for key in self.node_keys[node]:
+                del self.ring[key]
+                removed.add(key)
+            self.node_keys[node] = []
+        if removed:
+            self.sorted_keys = array('Q', (key for key in self.sorted_keys if key not in removed))
+        self.version += 1
 
     def get_node(self, key_str):
         """
@@ -53,18 +196,259 @@ class ConsistentHashing:
         """
         if not self.ring:
             return None
+        if self.cache_size:
+            if self.cache_version != self.version:
+                self.cache.clear()
+                self.cache_version = self.version
+            node = self.cache.get(key_str)
+            if node is not None:
+                self.cache.move_to_end(key_str)
+                return node
         key = self._hash(key_str)
         # 查找第一个大于等于key的虚拟节点的索引
         idx = bisect.bisect_left(self.sorted_keys, key)
         # 如果索引等于列表长度，说明key大于所有虚拟节点，回到环的起点
         if idx == len(self.sorted_keys):
             idx = 0
-        return self.ring[self.sorted_keys[idx]]
+        node = self.ring[self.sorted_keys[idx]]
+        if self.cache_size:
+            self.cache[key_str] = node
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return node
+
+    def get_nodes(self, key_strs):
+        """
+        批量查找：一次 searchsorted 定位全部key，返回与key_strs一一对应的节点列表
+        """
+        if not self.ring:
+            return [None] * len(key_strs)
+        ring_keys = np.frombuffer(self.sorted_keys, dtype=np.uint64)
+        hashes = np.fromiter((self._hash(key_str) for key_str in key_strs), dtype=np.uint64, count=len(key_strs))
+        idx = np.searchsorted(ring_keys, hashes, side='left')
+        idx[idx == len(ring_keys)] = 0
+        return [self.ring[int(key)] for key in ring_keys[idx]]
+
+    def _candidates(self, key_str):
+        """
+        从key_str的位置顺时针走，依次产出不重复的节点，最多走一圈虚拟节点
+        """
+        if not self.ring:
+            return
+        start = bisect.bisect_left(self.sorted_keys, self._hash(key_str))
+        seen = set()
+        n = len(self.sorted_keys)
+        for i in range(n):
+            node = self.ring[self.sorted_keys[(start + i) % n]]
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node
+            if len(seen) == len(self.loads):
+                break
 
     def _hash(self, key_str):
         """
-        计算哈希值
+        计算64位哈希值
         """
-        m = hashlib.md5()
-        m.update(str(key_str).encode('utf-8'))
-        return int(m.hexdigest(), 16)
\ No newline at end of file
+        return self.hash_func(key_str)
+
+def jump_hash(key, num_buckets):
+    """
+    Jump一致性哈希（Lamping & Veach）：把64位key映射到 [0, num_buckets) 中的桶
+    """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+class JumpHashing(BoundedLoad):
+    def __init__(self, nodes=None, load_factor=1.25, hash_func="blake2b-64"):
+        """
+        Jump一致性哈希：不需要虚拟节点，内存 O(节点数)，负载天然均匀，适合成员很少变化的能力池。
+        节点按加入顺序占用桶号；移除中间节点时由最后一个节点补位，
+        因此移除会搬动被移除节点和最后一个节点的key（约2/n），在末尾增删只搬动约1/n。
+        :param nodes:         初始节点
+        :param load_factor:   有界负载的容量系数c
+        :param hash_func:     64位哈希函数，HASH_FUNCTIONS中的名字或可调用对象
+        """
+        super().__init__(load_factor)
+        self.hash_func = HASH_FUNCTIONS[hash_func] if isinstance(hash_func, str) else hash_func
+        self.buckets = []           # 桶号 -> node
+        self.bucket_of = dict()     # node -> 桶号
+        if nodes:
+            for node in nodes:
+                self.add_node(node)
+
+    def add_node(self, node, replicas=None):
+        """
+        添加node（放在最后一个桶），replicas仅为与环接口一致，Jump哈希不支持权重
+        """
+        if node in self.bucket_of:
+            return
+        self.bucket_of[node] = len(self.buckets)
+        self.buckets.append(node)
+        self._track(node)
+
+    def remove_node(self, node):
+        """
+        移除node，最后一个节点移到它的桶号上
+        """
+        idx = self.bucket_of.pop(node, None)
+        if idx is None:
+            return
+        last = self.buckets.pop()
+        if last != node:
+            self.buckets[idx] = last
+            self.bucket_of[last] = idx
+        self._untrack(node)
+
+    def weight(self, node):
+        return 1 if node in self.bucket_of else None
+
+    def set_weight(self, node, replicas):
+        """
+        Jump哈希不支持权重，忽略
+        """
+
+    def get_node(self, key_str):
+        if not self.buckets:
+            return None
+        return self.buckets[jump_hash(self.hash_func(key_str), len(self.buckets))]
+
+    def _candidates(self, key_str):
+        """
+        从key_str所在的桶开始依次产出各桶的节点
+        """
+        n = len(self.buckets)
+        if not n:
+            return
+        start = jump_hash(self.hash_func(key_str), n)
+        for i in range(n):
+            yield self.buckets[(start + i) % n]
+
+class RendezvousHashing(BoundedLoad):
+    def __init__(self, nodes=None, replicas=10, load_factor=1.25, hash_func="blake2b-64"):
+        """
+        加权最高随机权重（HRW）哈希：每个key选 -weight / ln(u) 最大的节点，u为(节点, key)的哈希映射到(0,1)。
+        负载按权重成比例、增删节点只搬动该节点的key，查找代价 O(节点数)，适合小能力池。
+        :param nodes:         初始节点
+        :param replicas:      默认权重，与环的虚拟节点数含义一致（add_node 的 replicas 即权重）
+        :param load_factor:   有界负载的容量系数c
+        :param hash_func:     64位哈希函数，HASH_FUNCTIONS中的名字或可调用对象
+        """
+        super().__init__(load_factor)
+        self.replicas = replicas
+        self.hash_func = HASH_FUNCTIONS[hash_func] if isinstance(hash_func, str) else hash_func
+        self.weights = dict()       # node -> 权重
+        if nodes:
+            for node in nodes:
+                self.add_node(node)
+
+    def add_node(self, node, replicas=None):
+        """
+        添加或更新node，replicas作为权重
+        """
+        self.weights[node] = replicas if replicas is not None else self.replicas
+        self._track(node)
+
+    def remove_node(self, node):
+        if self.weights.pop(node, None) is not None:
+            self._untrack(node)
+
+    def weight(self, node):
+        return self.weights.get(node)
+
+    def set_weight(self, node, replicas):
+        if node in self.weights:
+            self.weights[node] = max(1, replicas)
+
+    def _score(self, node, key_str):
+        u = (self.hash_func(f"{node}:{key_str}") + 0.5) / 18446744073709551616.0
+        return -self.weights[node] / math.log(u)
+
+    def get_node(self, key_str):
+        if not self.weights:
+            return None
+        return max(self.weights, key=lambda node: self._score(node, key_str))
+
+    def _candidates(self, key_str):
+        """
+        按得分从高到低产出节点
+        """
+        yield from sorted(self.weights, key=lambda node: self._score(node, key_str), reverse=True)
+
+class ThroughputTracker:
+    def __init__(self, alpha=0.3, max_step=2, min_weight=1, max_weight=40):
+        """
+        按实测吞吐给节点重新分配权重（虚拟节点数）
+        :param alpha:         服务时间EWMA的平滑系数
+        :param max_step:      每次重新分配时单个节点权重的最大变化量，限制每轮搬动的key数
+        :param min_weight:    权重下限
+        :param max_weight:    权重上限
+        """
+        self.alpha = alpha
+        self.max_step = max_step
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.dispatched = dict()    # node -> 在途子任务的分发时间队列（先进先出）
+        self.service_time = dict()  # node -> 单个子任务耗时的EWMA（秒）
+
+    def on_dispatch(self, node, ts=None):
+        """
+        记录向node分发一个子任务；同一node可以有多个在途子任务（有界负载允许），按分发顺序排队
+        """
+        self.dispatched.setdefault(node, deque()).append(ts if ts is not None else time.time())
+
+    def on_complete(self, node, ts=None):
+        """
+        记录node完成一个子任务，按先进先出与最早的在途分发配对，返回本次耗时（没有对应的分发记录时返回None）
+        """
+        pending = self.dispatched.get(node)
+        if not pending:
+            return None
+        start = pending.popleft()
+        if not pending:
+            del self.dispatched[node]
+        elapsed = max((ts if ts is not None else time.time()) - start, 1e-6)
+        prev = self.service_time.get(node)
+        self.service_time[node] = elapsed if prev is None else (1 - self.alpha) * prev + self.alpha * elapsed
+        return elapsed
+
+    def forget(self, node):
+        self.dispatched.pop(node, None)
+        self.service_time.pop(node, None)
+
+    def rebalance(self, ring, base_weight):
+        """
+        按吞吐（1/服务时间）相对同环平均值的比例调整权重：目标为 base_weight(node) * 相对吞吐，
+        每次最多变化 max_step，尚无测量数据的节点保持不动；返回 {node: (旧权重, 新权重)}
+        :param ring:          ConsistentHashing / RendezvousHashing / JumpHashing
+        :param base_weight:   node -> 基础权重（如按能力数决定的虚拟节点数）
+        """
+        measured = {node: 1 / self.service_time[node] for node in ring.loads if node in self.service_time}
+        if not measured:
+            return {}
+        mean_rate = sum(measured.values()) / len(measured)
+        changes = {}
+        for node, rate in measured.items():
+            current = ring.weight(node)
+            if current is None:
+                continue
+            target = min(self.max_weight, max(self.min_weight, round(base_weight(node) * rate / mean_rate)))
+            step = max(-self.max_step, min(self.max_step, target - current))
+            if step:
+                ring.set_weight(node, current + step)
+                # 不支持权重的结构（如Jump哈希）set_weight 不生效，不计为调整
+                if ring.weight(node) != current:
+                    changes[node] = (current, ring.weight(node))
+        return changes
+
+# 能力池可选的路由结构，接口一致（add_node/remove_node/get_node/get_node_bounded/acquire/release）
+RING_TYPES = {
+    "ring": ConsistentHashing,
+    "jump": JumpHashing,
+    "rendezvous": RendezvousHashing,
+}
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+
+
+class DecompositionCache:
+    def __init__(self, path="decomposition_cache.sqlite3", ttl=7 * 24 * 3600, max_entries=10000):
+        """
+        任务拆解结果缓存，落盘到SQLite，跨进程、跨运行复用
+        :param path:          SQLite文件路径，":memory:" 表示只在内存中
+        :param ttl:           条目有效期（秒），None 表示不过期
+        :param max_entries:   条目数上限，超过时按最近使用时间淘汰（LRU）
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS decomposition ("
+            "key TEXT PRIMARY KEY, subtasks TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS decomposition_last_used ON decomposition(last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def normalize(content):
+        """
+        归一化任务内容：NFKC（全角/半角统一）、去首尾空白、连续空白合并为一个空格
+        """
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", content)).strip()
+
+    def key(self, content, abilities):
+        """
+        缓存键：归一化后的任务内容 + 排序后的能力集合
+        """
+        material = json.dumps([self.normalize(content), sorted(a.strip() for a in abilities)], ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, content, abilities):
+        """
+        查找拆解结果，未命中或已过期时返回None
+        """
+        key = self.key(content, abilities)
+        now = time.time()
+        row = self.conn.execute("SELECT subtasks, created FROM decomposition WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            self.conn.execute("DELETE FROM decomposition WHERE key = ?", (key,))
+            self.conn.commit()
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.conn.execute("UPDATE decomposition SET last_used = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, content, abilities, subtasks):
+        """
+        写入拆解结果，并清理过期条目、按LRU淘汰超出上限的条目
+        """
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO decomposition (key, subtasks, created, last_used) VALUES (?, ?, ?, ?)",
+            (self.key(content, abilities), json.dumps(subtasks, ensure_ascii=False), now, now)
+        )
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM decomposition WHERE created < ?", (now - self.ttl,))
+        if self.max_entries is not None:
+            self.conn.execute(
+                "DELETE FROM decomposition WHERE key IN ("
+                "SELECT key FROM decomposition ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM decomposition").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self)
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        print(f"[拆解缓存] 命中 {stats['hits']} 未命中 {stats['misses']} 命中率 {stats['hit_rate']:.1%} 条目 {stats['entries']}")
+        logging.info(f"[拆解缓存] 命中 {stats['hits']} 未命中 {stats['misses']} 命中率 {stats['hit_rate']:.1%} 条目 {stats['entries']}")
+
+    def close(self):
+        self.conn.close()
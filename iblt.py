@@ -1,8 +1,87 @@
+import asyncio
 import hashlib
 import heapq
+import math
 import random
 import json
+import mmap
+import os
+import struct
+import zlib
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+import numpy as np
+
+# 符号的长度前缀（小端 uint32），替代原来的 NUL 填充，
+# 使不同长度的符号可以直接按整数异或，且纯符号可以无损还原
+SYMBOL_LEN_PREFIX = struct.Struct('<I')
+
+# 编码符号的二进制线格式：
+#   头部   magic(2s) version(B) hash_id(B) flags(B) count(I) start(I)
+#   start 为首个编码符号在流中的下标，接收方据此拼接增量拉取的前缀
+#   版本3起 RandomMapping 改为递增步长映射，更早版本的载荷无法正确解码，直接拒绝
+#   每个符号 count(i) length(I) hash(digest_size 字节，小端) 累加器原始字节(length)
+# flags 置 WIRE_FLAG_ZLIB 时，头部之后的符号区整体经过 zlib 压缩
+WIRE_MAGIC = b'RI'
+WIRE_VERSION = 3
+WIRE_FLAG_ZLIB = 0x01
+WIRE_HEADER = struct.Struct('<2sBBBII')
+CODED_SYMBOL_HEADER = struct.Struct('<iI')
+
+# 多接收方共享流：主题前缀与每批编码符号数
+SHARED_STREAM_PREFIX = "iblt.stream"
+SHARED_BATCH_SIZE = 32
+
+# 64 位哈希的密钥，编码端与解码端必须一致
+SYMBOL_HASH_KEY = b'ed-agent-iblt'
+
+
+# 0. 可插拔的符号哈希
+class SymbolHash:
+    def __init__(self, name, hash_id, digest_size, func):
+        """
+        :param name: 哈希名称，写入线格式。
+        :param hash_id: 哈希编号，供二进制格式使用。
+        :param digest_size: 摘要字节数。
+        :param func: bytes -> int 的哈希函数。
+        """
+        self.name = name
+        self.hash_id = hash_id
+        self.digest_size = digest_size
+        self.func = func
+
+    def __call__(self, data):
+        return self.func(data)
+
+    def __repr__(self):
+        return f"SymbolHash('{self.name}')"
+
+def _sha256_hash(data):
+    # 与旧实现 int(hexdigest, 16) 的取值一致
+    return int.from_bytes(hashlib.sha256(data).digest(), 'big')
+
+def _blake2b_64_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8, key=SYMBOL_HASH_KEY).digest(), 'little')
+
+SYMBOL_HASHES = {
+    h.name: h for h in (
+        SymbolHash('sha256', 0, 32, _sha256_hash),
+        SymbolHash('blake2b-64', 1, 8, _blake2b_64_hash),
+    )
+}
+DEFAULT_SYMBOL_HASH = SYMBOL_HASHES['blake2b-64']
+
+def get_symbol_hash(hasher=None):
+    """按名称、编号或 SymbolHash 实例取得哈希函数，None 表示默认哈希。"""
+    if hasher is None:
+        return DEFAULT_SYMBOL_HASH
+    if isinstance(hasher, SymbolHash):
+        return hasher
+    for h in SYMBOL_HASHES.values():
+        if hasher == h.name or hasher == h.hash_id:
+            return h
+    raise ValueError(f"未知的符号哈希: {hasher}")
 
 
 # 1. Symbol 接口定义
@@ -24,40 +103,93 @@ class ContentSymbol(Symbol):
             self.data = data
         else:
             self.data = str(data).encode('utf-8')
+        self._value = None
+        self._hash = None
+
+    def to_int(self):
+        """返回 长度前缀+数据 的小端整数表示，整块异或只需一次整数运算。"""
+        if self._value is None:
+            self._value = int.from_bytes(SYMBOL_LEN_PREFIX.pack(len(self.data)) + self.data, 'little')
+        return self._value
+
+    @classmethod
+    def from_int(cls, value):
+        """由整数表示还原符号，按长度前缀截取数据；整数表示丢掉了末尾的零字节，按长度补回。"""
+        raw = value_to_bytes(value)
+        (length,) = SYMBOL_LEN_PREFIX.unpack_from(raw)
+        return cls(raw[SYMBOL_LEN_PREFIX.size:SYMBOL_LEN_PREFIX.size + length].ljust(length, b'\0'))
 
     def xor(self, other: 'ContentSymbol') -> 'ContentSymbol':
-        # 确保两个字节串长度一致
-        len1, len2 = len(self.data), len(other.data)
-        if len1 < len2:
-            d1 = self.data.ljust(len2, b'\0')
-            d2 = other.data
-        else:
-            d1 = self.data
-            d2 = other.data.ljust(len1, b'\0')
-        
-        res = bytes(a ^ b for a, b in zip(d1, d2))
-        return ContentSymbol(res)
+        return ContentSymbol.from_int(self.to_int() ^ other.to_int())
 
-    def hash(self):
-        return int(hashlib.sha256(self.data).hexdigest(), 16)
+    def hash(self, hasher=None):
+        # 结果按哈希函数缓存在符号上，避免重复计算
+        hasher = get_symbol_hash(hasher)
+        if self._hash is None or self._hash[0] is not hasher:
+            self._hash = (hasher, hasher(self.data))
+        return self._hash[1]
 
     def __repr__(self):
         return f"ContentSymbol('{self.data.decode('utf-8', errors='ignore')}')"
 
+def value_to_bytes(value):
+    """整数累加器转为小端字节串，至少保留长度前缀的宽度。"""
+    return value.to_bytes(max(SYMBOL_LEN_PREFIX.size, (value.bit_length() + 7) // 8), 'little')
+
 # 3. 数据结构
 class HashedSymbol:
-    def __init__(self, symbol):
+    def __init__(self, symbol, hasher=None, hash_value=None):
         self.symbol = symbol
-        self.hash = symbol.hash()
+        self.hash = symbol.hash(hasher) if hash_value is None else hash_value
+        self.value = symbol.to_int()
 
 class CodedSymbol:
     def __init__(self):
-        self.symbol = ContentSymbol(b'')
+        # 累加器以整数保存，apply 时原地异或，不再为每次异或分配新符号
+        self.value = 0
         self.hash = 0
         self.count = 0
 
+    @property
+    def symbol(self):
+        return ContentSymbol.from_int(self.value)
+
+    @symbol.setter
+    def symbol(self, symbol):
+        self.value = symbol.to_int()
+
+    def pure_symbol(self):
+        """
+        若累加器是一个完整的符号（长度前缀之后没有多余的非零字节）则返回它，否则返回 None。
+        哈希缩短到 64 位后，用这一结构校验配合哈希比较来排除伪纯符号。
+        """
+        raw = value_to_bytes(self.value)
+        (length,) = SYMBOL_LEN_PREFIX.unpack_from(raw)
+        if SYMBOL_LEN_PREFIX.size + length < len(raw):
+            return None
+        return ContentSymbol(raw[SYMBOL_LEN_PREFIX.size:].ljust(length, b'\0'))
+
+    def to_bytes(self):
+        """累加器的原始字节（未纯化的编码符号也能无损传输）。"""
+        return value_to_bytes(self.value)
+
+    @classmethod
+    def from_bytes(cls, raw, hash_value, count):
+        cs = cls()
+        cs.value = int.from_bytes(raw, 'little')
+        cs.hash = hash_value
+        cs.count = count
+        return cs
+
+    def copy(self):
+        cs = CodedSymbol()
+        cs.value = self.value
+        cs.hash = self.hash
+        cs.count = self.count
+        return cs
+
     def apply(self, s, direction):
-        self.symbol = self.symbol.xor(s.symbol)
+        self.value ^= s.value
         self.hash ^= s.hash
         self.count += direction
         return self
@@ -65,26 +197,31 @@ class CodedSymbol:
 # 4. 随机映射
 class RandomMapping:
     def __init__(self, seed, last_idx=0):
-        self.state = seed
+        self.state = seed & 0xFFFFFFFFFFFFFFFF
         self.last_idx = last_idx
 
     def next_index(self):
-        # 简单的伪随机数生成器
-        self.state = (self.state * 1103515245 + 12345) & 0xFFFFFFFFFFFFFFFF
-        self.last_idx += 1 + (self.state % 10) # 增加随机步长
+        # 步长随下标增长：符号映射到第 i 个编码符号的概率约为 1/(1+i/2)，
+        # 每个符号只落在 O(log m) 个编码符号上，剥离总代价随编码符号数近似线性增长。
+        # （旧实现的固定均值步长让每个编码符号都混入约 1/5.5 的差异符号，差异稍大就无法解码）
+        self.state = (self.state * 0xda942042e4dd58b5) & 0xFFFFFFFFFFFFFFFF
+        self.last_idx += math.ceil((self.last_idx + 1.5) * ((1 << 32) / math.sqrt(self.state + 1) - 1))
         return self.last_idx
 
 # 5. 编码窗口
 class CodingWindow:
-    def __init__(self):
+    def __init__(self, hasher=None):
+        self.hasher = get_symbol_hash(hasher)
         self.symbols = []
         self.mappings = []
         self.queue = []
+        self.removed = set()
         self.next_idx = 0
 
     def add_symbol(self, symbol):
-        hs = HashedSymbol(symbol)
+        hs = HashedSymbol(symbol, self.hasher)
         self.add_hashed_symbol(hs)
+        return len(self.symbols) - 1
 
     def add_hashed_symbol(self, hs):
         self.add_hashed_symbol_with_mapping(hs, RandomMapping(hs.hash))
@@ -94,6 +231,11 @@ class CodingWindow:
         self.mappings.append(m)
         heapq.heappush(self.queue, (m.last_idx, len(self.symbols) - 1))
 
+    def remove_symbol(self, source_idx):
+        """移除一个符号：先打上删除标记，等它下次出堆时丢弃，不再参与后续编码符号。"""
+        self.removed.add(source_idx)
+        self.symbols[source_idx] = None
+
     def apply_window(self, cw, direction):
         if not self.queue:
             self.next_idx += 1
@@ -101,6 +243,9 @@ class CodingWindow:
         
         while self.queue and self.queue[0][0] == self.next_idx:
             _, source_idx = heapq.heappop(self.queue)
+            if source_idx in self.removed:
+                self.removed.discard(source_idx)
+                continue
             cw = cw.apply(self.symbols[source_idx], direction)
             next_map_idx = self.mappings[source_idx].next_index()
             heapq.heappush(self.queue, (next_map_idx, source_idx))
@@ -112,6 +257,7 @@ class CodingWindow:
         self.symbols = []
         self.mappings = []
         self.queue = []
+        self.removed = set()
         self.next_idx = 0
 
 # 6. 编码器
@@ -119,14 +265,110 @@ class Encoder(CodingWindow):
     def produce_next_coded_symbol(self):
         return self.apply_window(CodedSymbol(), 1)
 
+    def produce_range(self, count):
+        return [self.produce_next_coded_symbol() for _ in range(count)]
+
+# 6.1 批量编码器
+MAPPING_MULTIPLIER = 0xda942042e4dd58b5
+# 映射下标超过该值即视为永远不会再被用到，避免 int64 溢出
+MAPPING_INDEX_LIMIT = 1 << 62
+
+def advance_mappings(states, last_idx):
+    """RandomMapping.next_index 的向量化版本，对一批映射各前进一步，浮点运算顺序与标量版完全一致。"""
+    states = states * np.uint64(MAPPING_MULTIPLIER)
+    # state + 1 在 uint64 上可能回绕为 0，此时对应的值是 2^64
+    plus_one = (states + np.uint64(1)).astype(np.float64)
+    plus_one[states == np.uint64(0xFFFFFFFFFFFFFFFF)] = 2.0 ** 64
+    step = np.ceil((last_idx.astype(np.float64) + 1.5) * (float(1 << 32) / np.sqrt(plus_one) - 1))
+    overflow = step >= MAPPING_INDEX_LIMIT - last_idx.astype(np.float64)
+    last_idx = last_idx + np.where(overflow, 0, step).astype(np.int64)
+    last_idx[overflow] = MAPPING_INDEX_LIMIT
+    return states, last_idx
+
+class BatchEncoder:
+    """
+    批量编码引擎：不再逐个下标出堆/入堆，而是对所有符号的映射做向量化推进，
+    一次产生一段连续的编码符号。输出与基于堆的 Encoder 逐字节一致，
+    接口与 Encoder 相同，可直接作为 EncoderSession 的编码引擎。
+    """
+    def __init__(self, hasher=None):
+        self.hasher = get_symbol_hash(hasher)
+        self.symbols = []
+        self.states = np.zeros(0, dtype=np.uint64)
+        self.last_idx = np.zeros(0, dtype=np.int64)
+        # 新加入的映射先暂存，产生编码符号前再并入数组
+        self.pending = []
+        self.next_idx = 0
+
+    def add_symbol(self, symbol):
+        hs = HashedSymbol(symbol, self.hasher)
+        self.add_hashed_symbol(hs)
+        return len(self.symbols) - 1
+
+    def add_hashed_symbol(self, hs):
+        self.add_hashed_symbol_with_mapping(hs, RandomMapping(hs.hash))
+
+    def add_hashed_symbol_with_mapping(self, hs, m):
+        self.symbols.append(hs)
+        self.pending.append((m.state, min(m.last_idx, MAPPING_INDEX_LIMIT)))
+
+    def remove_symbol(self, source_idx):
+        self._flush_pending()
+        self.symbols[source_idx] = None
+        self.last_idx[source_idx] = MAPPING_INDEX_LIMIT
+
+    def _flush_pending(self):
+        if self.pending:
+            states, last_idx = zip(*self.pending)
+            self.states = np.concatenate((self.states, np.array(states, dtype=np.uint64)))
+            self.last_idx = np.concatenate((self.last_idx, np.array(last_idx, dtype=np.int64)))
+            self.pending = []
+
+    def produce_next_coded_symbol(self):
+        return self.produce_range(1)[0]
+
+    def produce_range(self, count):
+        """产生下标 [next_idx, next_idx+count) 的编码符号。"""
+        self._flush_pending()
+        start, end = self.next_idx, self.next_idx + count
+        cells, sources = [], []
+        active = np.flatnonzero(self.last_idx < end)
+        while active.size:
+            cells.append(self.last_idx[active])
+            sources.append(active)
+            states, last_idx = advance_mappings(self.states[active], self.last_idx[active])
+            self.states[active] = states
+            self.last_idx[active] = last_idx
+            active = active[last_idx < end]
+
+        coded_symbols = [CodedSymbol() for _ in range(count)]
+        if cells:
+            cells = np.concatenate(cells) - start
+            sources = np.concatenate(sources)
+            counts = np.bincount(cells, minlength=count)
+            symbols = self.symbols
+            # 异或与计数都满足交换律，按任意顺序累加结果都与逐下标出堆一致
+            for cell, source in zip(cells.tolist(), sources.tolist()):
+                cs = coded_symbols[cell]
+                hs = symbols[source]
+                cs.value ^= hs.value
+                cs.hash ^= hs.hash
+            for cs, c in zip(coded_symbols, counts.tolist()):
+                cs.count = c
+        self.next_idx = end
+        return coded_symbols
+
 # 7. 解码器
 class Decoder:
-    def __init__(self):
+    def __init__(self, hasher=None):
+        self.hasher = get_symbol_hash(hasher)
         self.cs = []
-        self.local = CodingWindow()
-        self.window = CodingWindow()
-        self.remote = CodingWindow()
-        self.decodable = []
+        self.local = CodingWindow(self.hasher)
+        self.window = CodingWindow(self.hasher)
+        self.remote = CodingWindow(self.hasher)
+        # 待剥离队列 + 成员位图，出队和判重都是 O(1)
+        self.decodable = deque()
+        self.queued = bytearray()
         self.decoded_count = 0
 
     def decoded(self):
@@ -140,23 +382,36 @@ class Decoder:
         c = self.remote.apply_window(c, -1)
         c = self.local.apply_window(c, 1)
         self.cs.append(c)
-        if (c.count == 1 or c.count == -1) and (c.hash == c.symbol.hash()):
-            self.decodable.append(len(self.cs) - 1)
-        elif c.count == 0 and c.hash == 0:
-            self.decodable.append(len(self.cs) - 1)
+        self.queued.append(0)
+        if self.is_pure(c) or (c.count == 0 and c.hash == 0 and c.value == 0):
+            self.enqueue(len(self.cs) - 1)
+
+    def enqueue(self, cidx):
+        if not self.queued[cidx]:
+            self.queued[cidx] = 1
+            self.decodable.append(cidx)
+
+    def is_pure(self, c):
+        """计数为 ±1，累加器结构完整，且哈希与内容一致。"""
+        if c.count != 1 and c.count != -1:
+            return False
+        symbol = c.pure_symbol()
+        return symbol is not None and c.hash == self.hasher(symbol.data)
 
     def try_decode(self):
         while self.decodable:
-            cidx = self.decodable.pop(0)
+            cidx = self.decodable.popleft()
+            self.queued[cidx] = 0
             c = self.cs[cidx]
 
+            # 纯符号的哈希已经校验过，直接复用 c.hash
             if c.count == 1:
-                hs = HashedSymbol(c.symbol)
+                hs = HashedSymbol(c.symbol, self.hasher, c.hash)
                 m = self.apply_new_symbol(hs, -1)
                 self.remote.add_hashed_symbol_with_mapping(hs, m)
                 self.decoded_count += 1
             elif c.count == -1:
-                hs = HashedSymbol(c.symbol)
+                hs = HashedSymbol(c.symbol, self.hasher, c.hash)
                 m = self.apply_new_symbol(hs, 1)
                 self.local.add_hashed_symbol_with_mapping(hs, m)
                 self.decoded_count += 1
@@ -165,55 +420,189 @@ class Decoder:
 
     def apply_new_symbol(self, t, direction):
         m = RandomMapping(t.hash)
-        while m.last_idx < len(self.cs):
+        cs = self.cs
+        while m.last_idx < len(cs):
             cidx = m.last_idx
-            self.cs[cidx] = self.cs[cidx].apply(t, direction)
-            if (self.cs[cidx].count == 1 or self.cs[cidx].count == -1) and \
-               (self.cs[cidx].hash == self.cs[cidx].symbol.hash()):
-                if cidx not in self.decodable:
-                    self.decodable.append(cidx)
+            c = cs[cidx].apply(t, direction)
+            if self.is_pure(c):
+                self.enqueue(cidx)
             m.next_index()
         return m
 
 # 8. Rateless IBLT 管理器
 class RatelessIBLTManager:
+    def __init__(self, symbol_hash=None, compress=False, engine=BatchEncoder):
+        """
+        :param symbol_hash: 编码使用的符号哈希（名称或 SymbolHash），默认 blake2b-64。
+                            解码端按载荷中记录的哈希解码，无需与此一致。
+        :param compress: 是否对二进制载荷做 zlib 压缩。
+        :param engine: 编码引擎，BatchEncoder 与 Encoder 输出一致，前者批量产生更快。
+        """
+        self.hasher = get_symbol_hash(symbol_hash)
+        self.compress = compress
+        self.engine = engine
+        self.sessions = {}
+        # 共享流主题 -> 已成功发布的编码符号数
+        self.published = {}
+        # 上下文id -> 当前的共享流主题，主题变化时丢弃旧主题的发布记录
+        self.stream_subjects = {}
+
     def encode(self, context_dict, num_symbols_multiplier=1.5):
-        encoder = Encoder()
+        encoder = self.engine(self.hasher)
         symbols_to_encode = []
         for key, value in context_dict.items():
-            # 处理bytes类型的值
-            if isinstance(value, bytes):
-                serializable_value = value.decode('utf-8')
-            else:
-                serializable_value = value
-            
-            # 将键值对序列化为符号
-            symbol_data = json.dumps({key: serializable_value}, sort_keys=True)
-            symbols_to_encode.append(ContentSymbol(symbol_data))
+            symbols_to_encode.append(context_item_symbol(key, value))
         
         for symbol in symbols_to_encode:
             encoder.add_symbol(symbol)
 
         num_symbols = int(len(symbols_to_encode) * num_symbols_multiplier)
-        
-        coded_symbols = []
-        for _ in range(num_symbols):
-            coded_symbols.append(encoder.produce_next_coded_symbol())
-        
+        coded_symbols = encoder.produce_range(num_symbols)
         return self.serialize_coded_symbols(coded_symbols)
 
     def decode(self, coded_symbols_serialized, local_context_dict):
-        decoder = Decoder()
-        for key, value in local_context_dict.items():
-            symbol_data = json.dumps({key: value}, sort_keys=True)
-            decoder.add_symbol(ContentSymbol(symbol_data))
+        """local_context_dict 也可以是 LocalSymbolIndex，此时直接使用索引中的符号和哈希。"""
+        hasher, coded_symbols = self.deserialize_payload(coded_symbols_serialized)
+        decoder = Decoder(hasher)
+        add_local_symbols(decoder, local_context_dict)
 
-        coded_symbols = self.deserialize_coded_symbols(coded_symbols_serialized)
         for cs in coded_symbols:
             decoder.add_coded_symbol(cs)
         
         decoder.try_decode()
+        return self.decoded_difference(decoder, local_context_dict)
+
+    # --- 分片编码：编码符号是异或线性的，不相交分片各自编码后逐个合并即得整体的编码符号 ---
+    def encode_sharded(self, context_dict, shards, num_symbols_multiplier=1.5, executor=None):
+        """
+        按键的哈希区间把上下文切成 shards 片，各片独立编码（executor 非空时并行，可为进程池）后合并。
+        结果与直接 encode(context_dict) 一致。
+        """
+        num_symbols = int(len(context_dict) * num_symbols_multiplier)
+        parts = [[] for _ in range(shards)]
+        for key, value in context_dict.items():
+            parts[shard_of(key, shards)].append((key, value))
+        args = ([part for part in parts], [num_symbols] * shards, [self.hasher.name] * shards)
+        mapper = executor.map if executor is not None else map
+        return self.merge_payloads(list(mapper(encode_shard, *args)))
+
+    def merge_payloads(self, payloads):
+        """合并若干分片各自编码的载荷（须为同一哈希、同一起始下标、同样长度）。"""
+        streams = [self.deserialize_stream(payload) for payload in payloads]
+        hashers = {hasher.name for hasher, _, _ in streams}
+        starts = {start for _, start, _ in streams}
+        if len(hashers) != 1 or len(starts) != 1:
+            raise ValueError("分片载荷的哈希或起始下标不一致，无法合并")
+        merged = merge_coded_symbols([coded_symbols for _, _, coded_symbols in streams])
+        manager = RatelessIBLTManager(streams[0][0], self.compress, self.engine)
+        return manager.serialize_coded_symbols(merged, starts.pop())
+
+    async def decode_async(self, coded_symbols_serialized, local_context_dict, executor=None, shards=1):
+        """
+        decode 的异步版本，在线程池/进程池中执行，不阻塞事件循环。
+        本地上下文按条目切成 shards 片，在 executor 中并行完成序列化和符号哈希，
+        再把预先算好的符号交给一个 worker 剥离。executor 为 None 时使用默认线程池。
+        local_context_dict 也可以是 LocalSymbolIndex：哈希与载荷一致时直接使用索引中的符号，
+        否则只对索引中的符号数据重新哈希。
+        """
+        loop = asyncio.get_running_loop()
+        # memoryview 不能跨进程传递
+        data = bytes(coded_symbols_serialized) if isinstance(coded_symbols_serialized, memoryview) else coded_symbols_serialized
+        hash_name = self.payload_symbol_hash(data).name
+        if isinstance(local_context_dict, LocalSymbolIndex):
+            # 索引持有打开的日志文件，不能跨进程传递，判断新增/更新只需要键集合
+            local_keys = set(local_context_dict.keys())
+            if local_context_dict.hasher.name == hash_name:
+                local_symbols = list(local_context_dict.symbols())
+                return await loop.run_in_executor(executor, decode_with_local_symbols, data, local_symbols, local_keys)
+            work, items = hash_symbol_data, [symbol_data for symbol_data, _ in local_context_dict.symbols()]
+        else:
+            local_keys = local_context_dict
+            work, items = hash_context_items, list(local_context_dict.items())
+        shards = max(1, min(shards, len(items)))
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(executor, work, items[i::shards], hash_name) for i in range(shards)
+        ))
+        local_symbols = [symbol for part in parts for symbol in part]
+        return await loop.run_in_executor(executor, decode_with_local_symbols, data, local_symbols, local_keys)
+
+    def payload_symbol_hash(self, serialized_data):
+        """载荷所用的符号哈希，二进制载荷只读头部。"""
+        view = memoryview(serialized_data.encode('utf-8') if isinstance(serialized_data, str) else serialized_data)
+        if view[:len(WIRE_MAGIC)] == WIRE_MAGIC:
+            return get_symbol_hash(WIRE_HEADER.unpack_from(view)[2])
+        return self.deserialize_payload(view)[0]
+
+    # --- 流式编码：按上下文保留编码会话，接收方按需拉取更多前缀 ---
+    def open_session(self, context_id, context_dict):
+        """为上下文创建（或替换）一个持久的编码会话。"""
+        session = EncoderSession(context_dict, self.hasher, self.engine)
+        self.sessions[context_id] = session
+        return session
+
+    def get_session(self, context_id):
+        return self.sessions.get(context_id)
+
+    def estimate_difference(self, context_id, remote_estimator):
+        """用接收方公布的分层估计器估计其与会话上下文的差异大小。"""
+        return self.sessions[context_id].get_estimator().estimate(remote_estimator)
 
+    def sync_session(self, context_id, context_dict):
+        """让会话与最新上下文对齐：会话不存在时新建，否则只增量处理变化的键。"""
+        session = self.sessions.get(context_id)
+        if session is None:
+            return self.open_session(context_id, context_dict)
+        session.sync(context_dict)
+        return session
+
+    def close_session(self, context_id):
+        self.sessions.pop(context_id, None)
+        subject = self.stream_subjects.pop(context_id, None)
+        if subject is not None:
+            self.published.pop(subject, None)
+
+    def encode_range(self, context_id, start, count):
+        """序列化会话中下标 [start, start+count) 的编码符号，不足时继续产生。"""
+        session = self.sessions[context_id]
+        return self.serialize_coded_symbols(session.get_range(start, start + count), start)
+
+    # --- 多接收方共享流：同一上下文版本只产生、发布一条编码符号流，各接收方按需读取前缀 ---
+    def stream_subject(self, context_id):
+        """上下文当前内容对应的共享流 NATS 主题，内容变化后主题随之变化。"""
+        _, count, hash_xor = self.sessions[context_id].content_digest()
+        return f"{SHARED_STREAM_PREFIX}.{context_id}.{count}-{hash_xor:x}"
+
+    def shared_batches(self, context_id, upto, batch_size=SHARED_BATCH_SIZE):
+        """
+        返回 (主题, [(批次结束下标, 载荷)])：共享流上尚未发布、覆盖前 upto 个编码符号所需的批次。
+        不改变发布记录，调用方每成功发布一批后用 mark_published 记下，发布失败的批次下次会重新返回；
+        已发布的部分不会重复返回，因此多个接收方的需求只取最大值。
+        """
+        subject = self.stream_subject(context_id)
+        previous = self.stream_subjects.get(context_id)
+        if previous != subject:
+            # 上下文内容已变化，旧主题不会再续发
+            if previous is not None:
+                self.published.pop(previous, None)
+            self.stream_subjects[context_id] = subject
+        published = self.published.get(subject, 0)
+        batches = []
+        while published < upto:
+            batches.append((published + batch_size, self.encode_range(context_id, published, batch_size)))
+            published += batch_size
+        return subject, batches
+
+    def mark_published(self, subject, end):
+        """记录共享流 subject 上前 end 个编码符号已发布（并发发布时只前进不后退），主题已被替换时忽略。"""
+        if subject in self.published or subject in self.stream_subjects.values():
+            self.published[subject] = max(self.published.get(subject, 0), end)
+
+    def new_decoder(self, local_context_dict):
+        """创建增量解码器，配合 encode_range 逐段喂入前缀直到解码完成。"""
+        return IncrementalDecoder(self, local_context_dict)
+
+    def decoded_difference(self, decoder, local_context_dict):
+        """从（已完成剥离的）解码器中提取 (added, removed, updated)。"""
         added = {}
         removed = set()
         updated = {}
@@ -237,51 +626,875 @@ class RatelessIBLTManager:
 
         return added, removed, updated
 
-    def serialize_coded_symbols(self, coded_symbols):
-        return json.dumps([
-            {
-                "symbol": cs.symbol.data.decode('latin1'), # 使用 'latin1' 编码以避免Unicode错误
-                "hash": cs.hash,
-                "count": cs.count
-            } for cs in coded_symbols
-        ])
+    def serialize_coded_symbols(self, coded_symbols, start=0):
+        """序列化为版本化、带长度前缀的二进制载荷（bytes），start 为首个符号在流中的下标。"""
+        digest_size = self.hasher.digest_size
+        body = bytearray()
+        for cs in coded_symbols:
+            raw = cs.to_bytes()
+            body += CODED_SYMBOL_HEADER.pack(cs.count, len(raw))
+            body += cs.hash.to_bytes(digest_size, 'little')
+            body += raw
+        flags = 0
+        if self.compress:
+            body = zlib.compress(body)
+            flags |= WIRE_FLAG_ZLIB
+        header = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, self.hasher.hash_id, flags, len(coded_symbols), start)
+        return header + bytes(body)
+
+    def serialize_coded_symbols_json(self, coded_symbols):
+        """旧的 JSON 格式，仅为兼容和对比保留。"""
+        return json.dumps({
+            "hash": self.hasher.name, # 记录所用哈希，保证两端一致
+            "symbols": [
+                {
+                    "symbol": cs.to_bytes().decode('latin1'), # 使用 'latin1' 编码以避免Unicode错误
+                    "hash": cs.hash,
+                    "count": cs.count
+                } for cs in coded_symbols
+            ]
+        })
+
+    def deserialize_payload(self, serialized_data):
+        """解析载荷，返回 (符号哈希, 编码符号列表)。支持 bytes/memoryview 二进制载荷和旧的 JSON 载荷。"""
+        hasher, _, coded_symbols = self.deserialize_stream(serialized_data)
+        return hasher, coded_symbols
+
+    def deserialize_stream(self, serialized_data):
+        """解析载荷，返回 (符号哈希, 起始下标, 编码符号列表)。"""
+        view = memoryview(serialized_data.encode('utf-8') if isinstance(serialized_data, str) else serialized_data)
+        if view[:len(WIRE_MAGIC)] == WIRE_MAGIC:
+            return self._deserialize_binary(view)
+        data = json.loads(bytes(view))
+        if isinstance(data, list):
+            # 最早的列表格式使用旧的随机映射，无法正确解码
+            raise ValueError("不支持的IBLT载荷: 旧版列表格式")
+        hasher, items = get_symbol_hash(data['hash']), data['symbols']
+        coded_symbols = []
+        for item in items:
+            cs = CodedSymbol.from_bytes(item['symbol'].encode('latin1'), item['hash'], item['count'])
+            coded_symbols.append(cs)
+        return hasher, 0, coded_symbols
 
     def deserialize_coded_symbols(self, serialized_data):
-        data = json.loads(serialized_data)
+        return self.deserialize_payload(serialized_data)[1]
+
+    def _deserialize_binary(self, view):
+        version = view[len(WIRE_MAGIC)]
+        if version != WIRE_VERSION:
+            raise ValueError(f"不支持的IBLT载荷版本: {version}")
+        magic, version, hash_id, flags, count, start = WIRE_HEADER.unpack_from(view)
+        body = view[WIRE_HEADER.size:]
+        hasher = get_symbol_hash(hash_id)
+        if flags & WIRE_FLAG_ZLIB:
+            body = memoryview(zlib.decompress(body))
+        digest_size = hasher.digest_size
+        offset = 0
         coded_symbols = []
-        for item in data:
-            cs = CodedSymbol()
-            cs.symbol = ContentSymbol(item['symbol'].encode('latin1'))
-            cs.hash = item['hash']
-            cs.count = item['count']
+        for _ in range(count):
+            symbol_count, length = CODED_SYMBOL_HEADER.unpack_from(body, offset)
+            offset += CODED_SYMBOL_HEADER.size
+            hash_value = int.from_bytes(body[offset:offset + digest_size], 'little')
+            offset += digest_size
+            cs = CodedSymbol.from_bytes(body[offset:offset + length], hash_value, symbol_count)
+            offset += length
             coded_symbols.append(cs)
-        return coded_symbols
+        return hasher, start, coded_symbols
+
+# 9. 编码会话
+class EncoderSession:
+    """
+    按上下文持久保存的编码器。已产生的编码符号会缓存下来，
+    不同接收方可以从任意下标继续拉取，直到各自解码成功。
+    上下文变化时用 add/remove/update 只把变化的符号异或进/出已缓存的前缀，
+    每次变化 version 加一，跨版本拼接的前缀无法解码。
+    """
+    def __init__(self, context_dict, hasher=None, engine=Encoder):
+        """
+        :param context_dict: 上下文字典。
+        :param hasher: 符号哈希。
+        :param engine: 编码引擎，Encoder（逐下标出堆）或 BatchEncoder（批量向量化）。
+        """
+        self.encoder = engine(hasher)
+        self.hasher = self.encoder.hasher
+        self.coded_symbols = []
+        self.version = 0
+        # 所有符号哈希的异或，随增删 O(1) 维护，作为与顺序无关的内容摘要
+        self.hash_xor = 0
+        # 差异估计器，首次需要时才构建，之后随增删同步维护
+        self.estimator = None
+        # key -> (编码窗口中的下标, 值)
+        self.entries = {}
+        for key, value in context_dict.items():
+            source_idx = self.encoder.add_symbol(context_item_symbol(key, value))
+            self.hash_xor ^= self.encoder.symbols[source_idx].hash
+            self.entries[key] = (source_idx, value)
+
+    def __len__(self):
+        """上下文中的符号数。"""
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_estimator(self):
+        """当前上下文的分层差异估计器。"""
+        if self.estimator is None:
+            self.estimator = StrataEstimator()
+            for source_idx, _ in self.entries.values():
+                self.estimator.add(self.encoder.symbols[source_idx].symbol.data)
+        return self.estimator
+
+    def content_digest(self):
+        """上下文内容摘要，内容相同则摘要相同（与 version 不同，重建会话后仍然一致）。"""
+        return (self.hasher.name, len(self.entries), self.hash_xor)
+
+    def add(self, key, value):
+        """新增键值对，已存在时等同于 update。"""
+        if key in self.entries:
+            self.update(key, value)
+            return
+        hs = HashedSymbol(context_item_symbol(key, value), self.hasher)
+        m = self._apply_to_prefix(hs, 1)
+        # 映射已越过缓存的前缀，从下一个待产生的编码符号接着编码
+        self.encoder.add_hashed_symbol_with_mapping(hs, m)
+        self.entries[key] = (len(self.encoder.symbols) - 1, value)
+        self.hash_xor ^= hs.hash
+        if self.estimator is not None:
+            self.estimator.add(hs.symbol.data)
+        self.version += 1
+
+    def remove(self, key):
+        """删除键，不存在时忽略。"""
+        if key not in self.entries:
+            return
+        source_idx, _ = self.entries.pop(key)
+        hs = self.encoder.symbols[source_idx]
+        self._apply_to_prefix(hs, -1)
+        self.encoder.remove_symbol(source_idx)
+        self.hash_xor ^= hs.hash
+        if self.estimator is not None:
+            self.estimator.remove(hs.symbol.data)
+        self.version += 1
+
+    def update(self, key, value):
+        """更新键的值，值未变化时不做任何事。"""
+        if key in self.entries and self.entries[key][1] == value:
+            return
+        self.remove(key)
+        self.add(key, value)
+
+    def sync(self, context_dict):
+        """与最新的上下文对齐，只处理有变化的键，返回变化的键数。"""
+        changed = [key for key in self.entries if key not in context_dict]
+        for key in changed:
+            self.remove(key)
+        for key, value in context_dict.items():
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != value:
+                self.update(key, value)
+                changed.append(key)
+        return len(changed)
+
+    def _apply_to_prefix(self, hs, direction):
+        """把符号异或进/出已缓存的编码符号，返回停在前缀之后的映射。"""
+        m = RandomMapping(hs.hash)
+        while m.last_idx < len(self.coded_symbols):
+            self.coded_symbols[m.last_idx].apply(hs, direction)
+            m.next_index()
+        return m
+
+    def produce(self, count):
+        """继续产生 count 个编码符号并缓存。"""
+        self.coded_symbols.extend(self.encoder.produce_range(count))
+
+    def get_range(self, start, stop):
+        """返回缓存中 [start, stop) 的编码符号（只读，解码器会原地修改传入的符号，需要时先 copy）。"""
+        if stop > len(self.coded_symbols):
+            self.produce(stop - len(self.coded_symbols))
+        return self.coded_symbols[start:stop]
+
+    def iter_coded_symbols(self, start=0):
+        """无限生成器，从 start 开始逐个产出编码符号的副本。"""
+        idx = start
+        while True:
+            yield self.get_range(idx, idx + 1)[0].copy()
+            idx += 1
+
+    async def aiter_coded_symbols(self, start=0, batch_size=64):
+        """异步迭代器，每次产出一批编码符号副本，批与批之间让出事件循环。"""
+        idx = start
+        while True:
+            yield [cs.copy() for cs in self.get_range(idx, idx + batch_size)]
+            idx += batch_size
+            await asyncio.sleep(0)
+
+# 10. 增量解码器
+class IncrementalDecoder:
+    """
+    子智能体侧的增量解码：逐段喂入编码符号前缀，decoded() 为真时即可取结果，
+    否则用 next_start() 向 meta 端请求后续的编码符号。
+    """
+    def __init__(self, manager, local_context_dict):
+        self.manager = manager
+        self.local_context = local_context_dict
+        self.decoder = None
+
+    def feed(self, serialized_data):
+        """喂入一段序列化的编码符号，返回是否已解码完成。"""
+        hasher, start, coded_symbols = self.manager.deserialize_stream(serialized_data)
+        if self.decoder is None:
+            self.decoder = Decoder(hasher)
+            add_local_symbols(self.decoder, self.local_context)
+        expected = len(self.decoder.cs)
+        if start > expected:
+            raise ValueError(f"编码符号不连续: 期望下标{expected}，收到{start}")
+        # 共享流上可能重复收到已处理过的批次，只取新的部分
+        for cs in coded_symbols[expected - start:]:
+            self.decoder.add_coded_symbol(cs)
+        self.decoder.try_decode()
+        return self.decoded()
+
+    async def feed_async(self, serialized_data, executor=None):
+        """feed 的异步版本，剥离在 executor（默认线程池）中进行，期间事件循环可以继续处理消息。"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.feed, serialized_data)
+
+    def decoded(self):
+        return self.decoder is not None and len(self.decoder.cs) > 0 and self.decoder.decoded()
+
+    def next_start(self):
+        """下一次拉取应从哪个下标开始。"""
+        return 0 if self.decoder is None else len(self.decoder.cs)
+
+    def result(self):
+        return self.manager.decoded_difference(self.decoder, self.local_context)
+
+# 11. 编码结果缓存
+class SketchCache:
+    """
+    RatelessIBLTManager 前面的 LRU 缓存，缓存已序列化的载荷，
+    同一上下文的重复分发和重试直接复用，超出内存预算时淘汰最久未用的条目。
+    """
+    def __init__(self, manager, max_bytes=64 * 1024 * 1024):
+        """
+        :param manager: RatelessIBLTManager 实例。
+        :param max_bytes: 缓存载荷的总字节预算。
+        """
+        self.manager = manager
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def context_digest(context_dict):
+        """上下文内容摘要，与键的插入顺序无关。"""
+        h = hashlib.blake2b(digest_size=16)
+        for key in sorted(context_dict, key=str):
+            data = context_item_symbol(key, context_dict[key]).data
+            h.update(SYMBOL_LEN_PREFIX.pack(len(data)))
+            h.update(data)
+        return h.hexdigest()
+
+    def encode(self, task_id, context_dict, num_symbols_multiplier=1.5):
+        """等同于 manager.encode，按 (任务, 内容摘要, 倍数) 缓存。"""
+        key = (task_id, self.context_digest(context_dict), num_symbols_multiplier)
+        payload = self.get(key)
+        if payload is None:
+            payload = self.manager.encode(context_dict, num_symbols_multiplier)
+            self.put(key, payload)
+        return payload
+
+    def encode_range(self, context_id, start, count):
+        """等同于 manager.encode_range，按 (上下文, 会话内容摘要, 区间) 缓存。"""
+        session = self.manager.get_session(context_id)
+        key = (context_id, session.content_digest(), start, count)
+        payload = self.get(key)
+        if payload is None:
+            payload = self.manager.encode_range(context_id, start, count)
+            self.put(key, payload)
+        return payload
+
+    def get(self, key):
+        payload = self.entries.get(key)
+        if payload is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return payload
+
+    def put(self, key, payload):
+        # 单个载荷超出预算时不缓存
+        if len(payload) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = payload
+        self.size += len(payload)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+def context_item_symbol(key, value):
+    """将上下文中的一个键值对序列化为符号，编码端与解码端共用。"""
+    # 处理bytes类型的值
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return ContentSymbol(json.dumps({key: value}, sort_keys=True))
+
+def add_local_symbols(decoder, local_context):
+    """把本地上下文（dict 或 LocalSymbolIndex）加入解码器。索引的哈希与载荷一致时免去序列化和哈希。"""
+    if isinstance(local_context, LocalSymbolIndex):
+        for data, hash_value in local_context.symbols():
+            symbol = ContentSymbol(data)
+            if local_context.hasher is decoder.hasher:
+                decoder.window.add_hashed_symbol(HashedSymbol(symbol, decoder.hasher, hash_value))
+            else:
+                decoder.add_symbol(symbol)
+        return
+    for key, value in local_context.items():
+        decoder.add_symbol(context_item_symbol(key, value))
+
+# 14. 本地符号索引
+# 日志文件格式：头部 magic(3s) version(B) hash_id(B)，
+# 之后是追加写的记录 op(B) key长度(I) 数据长度(I) 哈希(digest_size 字节) key 数据；op 为 1 写入、0 删除
+LOCAL_INDEX_MAGIC = b'LSI'
+LOCAL_INDEX_HEADER = struct.Struct('<3sBB')
+LOCAL_INDEX_RECORD = struct.Struct('<BII')
+
+class LocalSymbolIndex:
+    """
+    子智能体侧持久的本地符号索引：key -> (序列化后的符号数据, 符号哈希)。
+    上下文变化时增量更新，只有变化的键需要重新序列化和哈希；解码时直接交给
+    RatelessIBLTManager.decode / new_decoder 代替上下文字典。
+    给出 path 时以追加日志落盘，重启后用 mmap 读回，无需重新哈希。
+    符号的随机映射完全由哈希决定（见 mapping），因此不单独保存映射状态。
+    """
+    def __init__(self, hasher=None, path=None):
+        """
+        :param hasher: 符号哈希，应与 meta 端编码所用的一致（默认 blake2b-64）。
+                       打开已有日志时，None 表示沿用文件中记录的哈希，指定的哈希与文件不一致则抛出 ValueError。
+        :param path: 日志文件路径，None 表示只保存在内存中。
+        """
+        self.hasher = get_symbol_hash(hasher)
+        self.path = path
+        self.entries = {}
+        self.values = {}
+        self.garbage = 0
+        self._log = None
+        if path is not None:
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                self._load(hasher)
+            self._open_log()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def symbols(self):
+        """所有 (符号数据, 哈希)。"""
+        return self.entries.values()
+
+    def mapping(self, key):
+        """键对应符号的初始随机映射。"""
+        return RandomMapping(self.entries[key][1])
+
+    def set(self, key, value):
+        """写入键值对，值未变化时不重新哈希。返回是否有变化。"""
+        if key in self.values and self.values[key] == value:
+            return False
+        symbol = context_item_symbol(key, value)
+        self.values[key] = value
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == symbol.data:
+            return False
+        hash_value = symbol.hash(self.hasher)
+        if entry is not None:
+            self.garbage += 1
+        self.entries[key] = (symbol.data, hash_value)
+        self._append(1, key, symbol.data, hash_value)
+        return True
+
+    def delete(self, key):
+        if key not in self.entries:
+            return False
+        del self.entries[key]
+        self.values.pop(key, None)
+        self.garbage += 2
+        self._append(0, key, b'', 0)
+        return True
+
+    def sync(self, context_dict):
+        """与最新的本地上下文对齐，返回变化的键数。"""
+        changed = 0
+        for key in [key for key in self.entries if key not in context_dict]:
+            changed += self.delete(key)
+        for key, value in context_dict.items():
+            changed += self.set(key, value)
+        # 失效记录过多时压缩日志
+        if self._log is not None and self.garbage > max(1024, len(self.entries)):
+            self.compact()
+        return changed
+
+    # --- 持久化 ---
+    def _open_log(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._log = open(self.path, 'ab')
+        if new_file:
+            self._log.write(LOCAL_INDEX_HEADER.pack(LOCAL_INDEX_MAGIC, 1, self.hasher.hash_id))
+            self._log.flush()
+
+    def _append(self, op, key, data, hash_value):
+        if self._log is None:
+            return
+        key_bytes = str(key).encode('utf-8')
+        self._log.write(LOCAL_INDEX_RECORD.pack(op, len(key_bytes), len(data))
+                        + hash_value.to_bytes(self.hasher.digest_size, 'little') + key_bytes + data)
+        self._log.flush()
+
+    def _load(self, hasher=None):
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, hash_id = LOCAL_INDEX_HEADER.unpack_from(mm)
+            if magic != LOCAL_INDEX_MAGIC or version != 1:
+                raise ValueError(f"不是有效的本地符号索引文件: {self.path}")
+            recorded = get_symbol_hash(hash_id)
+            if hasher is not None and self.hasher.hash_id != hash_id:
+                raise ValueError(f"本地符号索引文件 {self.path} 使用的哈希为 {recorded.name}，与指定的 {self.hasher.name} 不一致")
+            self.hasher = recorded
+            digest_size = self.hasher.digest_size
+            offset = LOCAL_INDEX_HEADER.size
+            # 末尾可能有写了一半的记录，读到不完整处为止
+            while offset + LOCAL_INDEX_RECORD.size + digest_size <= len(mm):
+                op, key_len, data_len = LOCAL_INDEX_RECORD.unpack_from(mm, offset)
+                start = offset + LOCAL_INDEX_RECORD.size
+                end = start + digest_size + key_len + data_len
+                if end > len(mm):
+                    break
+                hash_value = int.from_bytes(mm[start:start + digest_size], 'little')
+                key = mm[start + digest_size:start + digest_size + key_len].decode('utf-8')
+                if op == 1:
+                    self.garbage += key in self.entries
+                    self.entries[key] = (mm[start + digest_size + key_len:end], hash_value)
+                else:
+                    self.garbage += 2
+                    self.entries.pop(key, None)
+                offset = end
+
+    def compact(self):
+        """只保留当前有效的记录，重写日志文件。"""
+        if self._log is None:
+            return
+        self._log.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(LOCAL_INDEX_HEADER.pack(LOCAL_INDEX_MAGIC, 1, self.hasher.hash_id))
+            for key, (data, hash_value) in self.entries.items():
+                key_bytes = str(key).encode('utf-8')
+                f.write(LOCAL_INDEX_RECORD.pack(1, len(key_bytes), len(data))
+                        + hash_value.to_bytes(self.hasher.digest_size, 'little') + key_bytes + data)
+        os.replace(tmp_path, self.path)
+        self.garbage = 0
+        self._log = open(self.path, 'ab')
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+def shard_of(key, shards):
+    """键所属的分片：把键的 64 位哈希空间均分为 shards 个区间，各 meta 进程据此划分自己负责的键。"""
+    return (_blake2b_64_hash(str(key).encode('utf-8')) * shards) >> 64
+
+def merge_coded_symbols(streams):
+    """
+    逐个合并多条等长的编码符号流：累加器和哈希异或，计数相加。
+    各流必须来自互不相交的符号集合（同一符号出现在两个分片里会被异或抵消）。
+    """
+    lengths = {len(stream) for stream in streams}
+    if len(lengths) > 1:
+        raise ValueError("编码符号流长度不一致，无法合并")
+    merged = []
+    for column in zip(*streams):
+        cs = column[0].copy()
+        for other in column[1:]:
+            cs.value ^= other.value
+            cs.hash ^= other.hash
+            cs.count += other.count
+        merged.append(cs)
+    return merged
+
+def encode_shard(items, num_symbols, hash_name=None):
+    """编码一个分片的 (key, value) 列表，返回前 num_symbols 个编码符号的载荷。模块级函数，可在进程池中执行。"""
+    manager = RatelessIBLTManager(hash_name)
+    encoder = manager.engine(manager.hasher)
+    for key, value in items:
+        encoder.add_symbol(context_item_symbol(key, value))
+    return manager.serialize_coded_symbols(encoder.produce_range(num_symbols))
+
+def hash_context_items(items, hash_name=None):
+    """序列化并哈希一批 (key, value)，返回 [(符号数据, 哈希)]。模块级函数，可在进程池中执行。"""
+    hasher = get_symbol_hash(hash_name)
+    symbols = [context_item_symbol(key, value) for key, value in items]
+    return [(symbol.data, symbol.hash(hasher)) for symbol in symbols]
+
+def hash_symbol_data(symbol_data, hash_name=None):
+    """用另一种哈希重新哈希已序列化的符号数据，返回 [(符号数据, 哈希)]。模块级函数，可在进程池中执行。"""
+    hasher = get_symbol_hash(hash_name)
+    return [(data, hasher(data)) for data in symbol_data]
+
+def decode_with_local_symbols(serialized_data, local_symbols, local_context_dict):
+    """
+    用预先算好的本地符号 [(符号数据, 哈希)] 解码，返回 (added, removed, updated)。可在进程池中执行。
+    local_context_dict 只用于区分新增和更新，可以是本地键的集合。
+    """
+    manager = RatelessIBLTManager()
+    hasher, coded_symbols = manager.deserialize_payload(serialized_data)
+    decoder = Decoder(hasher)
+    for data, hash_value in local_symbols:
+        decoder.window.add_hashed_symbol(HashedSymbol(ContentSymbol(data), hasher, hash_value))
+    for cs in coded_symbols:
+        decoder.add_coded_symbol(cs)
+    decoder.try_decode()
+    return manager.decoded_difference(decoder, local_context_dict)
 
 # 辅助函数，用于创建上下文值
 def create_context_value(doc_id, version, content):
     return {"doc_id": doc_id, "version": version, "content": content}
 
+# 12. 固定大小的经典 IBLT
+# 序列化格式：头部 magic(2s) version(B) hash_function_count(B) key_size(H) size(I)，
+# 之后依次是 count(int32) / keySum(uint8 x 单元宽度) / valueSum(uint64) / hashSum(uint64) 四个连续数组
+IBLT_MAGIC = b'IB'
+IBLT_VERSION = 1
+IBLT_HEADER = struct.Struct('<2sBBHI')
+IBLT_KEY_LEN_PREFIX = struct.Struct('<H')
+IBLT_HASH_PERSON = b'ed-agent-iblt'
+
+class IBLT:
+    """
+    单元以 NumPy 连续数组保存：count / keySum / valueSum / hashSum。
+    keySum 为 长度前缀+键 补齐到固定宽度；valueSum 保存值的 64 位摘要（差异解码只需要键，
+    值摘要用来区分同一个键的新旧版本）；单元位置由 (键, 值摘要) 决定，
+    因此同一个键被更新时新旧两个条目落在不同的单元里，可以分别剥离出来。
+    哈希函数按分区使用各自的 size // hash_function_count 个单元，避免同一条目重复落在一个单元。
+    """
+    def __init__(self, size, hash_function_count=3, key_size=64):
+        """
+        :param size: 单元数。
+        :param hash_function_count: 每个条目映射到的单元数。
+        :param key_size: 键的最大字节数。
+        """
+        if size < hash_function_count:
+            raise ValueError("IBLT的大小不能小于哈希函数数量")
+        self.size = size
+        self.hash_function_count = hash_function_count
+        self.key_size = key_size
+        self.cell_width = IBLT_KEY_LEN_PREFIX.size + key_size
+        self.counts = np.zeros(size, dtype=np.int32)
+        self.key_sums = np.zeros((size, self.cell_width), dtype=np.uint8)
+        self.value_sums = np.zeros(size, dtype=np.uint64)
+        self.hash_sums = np.zeros(size, dtype=np.uint64)
+
+    # --- 条目编码 ---
+    def _key_cell(self, key):
+        if len(key) > self.key_size:
+            raise ValueError(f"键长度{len(key)}超过IBLT的key_size={self.key_size}")
+        return (IBLT_KEY_LEN_PREFIX.pack(len(key)) + key).ljust(self.cell_width, b'\0')
+
+    def _entry(self, key_cell, value_digest):
+        """由单元内容计算 (hashSum, 单元下标列表)，插入和纯度校验共用。"""
+        k = self.hash_function_count
+        digest = hashlib.blake2b(key_cell + value_digest.to_bytes(8, 'little'),
+                                 digest_size=8 * (k + 1), person=IBLT_HASH_PERSON).digest()
+        hash_sum = int.from_bytes(digest[:8], 'little')
+        sub = self.size // k
+        indices = [i * sub + int.from_bytes(digest[8 * (i + 1):8 * (i + 2)], 'little') % sub for i in range(k)]
+        return hash_sum, indices
+
+    @staticmethod
+    def value_digest(value):
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8, person=IBLT_HASH_PERSON).digest(), 'little')
+
+    # --- 插入 ---
+    def insert(self, key, value):
+        self.insert_many([(key, value)])
+
+    def delete(self, key, value):
+        self.insert_many([(key, value)], direction=-1)
+
+    def insert_many(self, items, direction=1):
+        """批量插入 (key, value) 字节对：先算出所有条目的行，再用 ufunc.at 一次性累加到表中。"""
+        items = list(items)
+        if not items:
+            return
+        self._ensure_writable()
+        k = self.hash_function_count
+        rows = np.empty(len(items) * k, dtype=np.int64)
+        key_cells = np.empty((len(items), self.cell_width), dtype=np.uint8)
+        value_digests = np.empty(len(items), dtype=np.uint64)
+        hash_sums = np.empty(len(items), dtype=np.uint64)
+        for n, (key, value) in enumerate(items):
+            key_cell = self._key_cell(key)
+            value_digest = self.value_digest(value)
+            hash_sum, indices = self._entry(key_cell, value_digest)
+            rows[n * k:(n + 1) * k] = indices
+            key_cells[n] = np.frombuffer(key_cell, dtype=np.uint8)
+            value_digests[n] = value_digest
+            hash_sums[n] = hash_sum
+        np.add.at(self.counts, rows, direction)
+        np.bitwise_xor.at(self.key_sums, rows, np.repeat(key_cells, k, axis=0))
+        np.bitwise_xor.at(self.value_sums, rows, np.repeat(value_digests, k))
+        np.bitwise_xor.at(self.hash_sums, rows, np.repeat(hash_sums, k))
+
+    def _ensure_writable(self):
+        # from_serialized 得到的是只读的零拷贝视图，第一次写入前再复制
+        if not self.counts.flags.writeable:
+            self.counts = self.counts.copy()
+            self.key_sums = self.key_sums.copy()
+            self.value_sums = self.value_sums.copy()
+            self.hash_sums = self.hash_sums.copy()
+
+    # --- 差异 ---
+    def __xor__(self, other):
+        """
+        整表相减：count 相减，其余字段异或，均为整块向量运算。
+        a ^ b 的 list_entries() 返回 (只在 b 中的条目, 只在 a 中的条目)。
+        """
+        if (self.size, self.hash_function_count, self.key_size) != (other.size, other.hash_function_count, other.key_size):
+            raise ValueError("IBLT参数不一致，无法相减")
+        diff = IBLT(self.size, self.hash_function_count, self.key_size)
+        np.subtract(self.counts, other.counts, out=diff.counts)
+        np.bitwise_xor(self.key_sums, other.key_sums, out=diff.key_sums)
+        np.bitwise_xor(self.value_sums, other.value_sums, out=diff.value_sums)
+        np.bitwise_xor(self.hash_sums, other.hash_sums, out=diff.hash_sums)
+        return diff
+
+    def _pure_entry(self, idx):
+        """单元为纯单元时返回 (键单元, 值摘要, 下标列表)，否则返回 None。"""
+        count = int(self.counts[idx])
+        if count != 1 and count != -1:
+            return None
+        key_cell = self.key_sums[idx].tobytes()
+        value_digest = int(self.value_sums[idx])
+        hash_sum, indices = self._entry(key_cell, value_digest)
+        if hash_sum != int(self.hash_sums[idx]):
+            return None
+        return key_cell, value_digest, indices
+
+    def list_entries(self):
+        """
+        剥离差异表，返回 (count 为 -1 的条目, count 为 +1 的条目)，条目为 (key, 值摘要8字节)。
+        无法完全剥离（表太小）时抛出 ValueError。
+        """
+        table = IBLT(self.size, self.hash_function_count, self.key_size)
+        table.counts[:] = self.counts
+        table.key_sums[:] = self.key_sums
+        table.value_sums[:] = self.value_sums
+        table.hash_sums[:] = self.hash_sums
+
+        negative, positive = [], []
+        queue = deque(int(i) for i in np.flatnonzero((table.counts == 1) | (table.counts == -1)))
+        while queue:
+            idx = queue.popleft()
+            entry = table._pure_entry(idx)
+            if entry is None:
+                continue
+            key_cell, value_digest, indices = entry
+            count = int(table.counts[idx])
+            (length,) = IBLT_KEY_LEN_PREFIX.unpack_from(key_cell)
+            item = (key_cell[IBLT_KEY_LEN_PREFIX.size:IBLT_KEY_LEN_PREFIX.size + length], value_digest.to_bytes(8, 'little'))
+            (positive if count == 1 else negative).append(item)
+            key_row = np.frombuffer(key_cell, dtype=np.uint8)
+            hash_sum = table.hash_sums[idx]
+            for i in indices:
+                table.counts[i] -= count
+                table.key_sums[i] ^= key_row
+                table.value_sums[i] ^= np.uint64(value_digest)
+                table.hash_sums[i] ^= hash_sum
+                if table.counts[i] == 1 or table.counts[i] == -1:
+                    queue.append(i)
+
+        if table.counts.any() or table.hash_sums.any() or table.value_sums.any() or table.key_sums.any():
+            raise ValueError("IBLT容量不足，差异无法完全解码")
+        return negative, positive
+
+    # --- 序列化 ---
+    def nbytes(self):
+        """序列化后的字节数。"""
+        return IBLT_HEADER.size + self.size * (4 + self.cell_width + 8 + 8)
+
+    def serialize(self):
+        header = IBLT_HEADER.pack(IBLT_MAGIC, IBLT_VERSION, self.hash_function_count, self.key_size, self.size)
+        return b''.join((header, self.counts.astype('<i4', copy=False).tobytes(), self.key_sums.tobytes(),
+                         self.value_sums.astype('<u8', copy=False).tobytes(), self.hash_sums.astype('<u8', copy=False).tobytes()))
+
+    @classmethod
+    def from_serialized(cls, data, size=None, hash_function_count=None):
+        """
+        从序列化数据构建 IBLT，各数组直接是 data 上的零拷贝视图。
+        size / hash_function_count 若给出则必须与数据头一致。
+        """
+        view = memoryview(data)
+        magic, version, k, key_size, m = IBLT_HEADER.unpack_from(view)
+        if magic != IBLT_MAGIC or version != IBLT_VERSION:
+            raise ValueError("不是有效的IBLT序列化数据")
+        if (size is not None and size != m) or (hash_function_count is not None and hash_function_count != k):
+            raise ValueError(f"IBLT参数不一致: 数据为 size={m}, k={k}")
+        table = cls.__new__(cls)
+        table.size = m
+        table.hash_function_count = k
+        table.key_size = key_size
+        table.cell_width = IBLT_KEY_LEN_PREFIX.size + key_size
+        offset = IBLT_HEADER.size
+        table.counts = np.frombuffer(view, dtype='<i4', count=m, offset=offset)
+        offset += 4 * m
+        table.key_sums = np.frombuffer(view, dtype=np.uint8, count=m * table.cell_width, offset=offset).reshape(m, table.cell_width)
+        offset += m * table.cell_width
+        table.value_sums = np.frombuffer(view, dtype='<u8', count=m, offset=offset)
+        offset += 8 * m
+        table.hash_sums = np.frombuffer(view, dtype='<u8', count=m, offset=offset)
+        return table
+
+# 13. 分层差异估计器（Strata Estimator）
+STRATA_HEADER = struct.Struct('<2sBB')
+STRATA_MAGIC = b'SE'
+
+class StrataEstimator:
+    """
+    由若干层小 IBLT 组成：条目按其 64 位哈希末尾 0 的个数分到各层，第 i 层约含 1/2^(i+1) 的条目。
+    两个估计器相减后从最稀疏的层开始逐层解码，遇到第一个解不开的层 i 时，
+    已解出的条目数乘以 2^(i+1) 即为差异大小的估计。
+    子智能体在注册消息中公布自己的估计器，meta 端据此决定发送多少编码符号或 IBLT 多大。
+    """
+    def __init__(self, strata=16, cells=32, hash_function_count=3):
+        """
+        :param strata: 层数。
+        :param cells: 每层 IBLT 的单元数。
+        :param hash_function_count: 每层 IBLT 的哈希函数数量。
+        """
+        self.strata = strata
+        self.tables = [IBLT(cells, hash_function_count, key_size=8) for _ in range(strata)]
+
+    @classmethod
+    def from_context(cls, context_dict, **kwargs):
+        estimator = cls(**kwargs)
+        for key, value in context_dict.items():
+            estimator.add(context_item_symbol(key, value).data)
+        return estimator
+
+    def _locate(self, data):
+        h = _blake2b_64_hash(data)
+        # 末尾 0 的个数决定所在层
+        level = ((h & -h).bit_length() - 1) if h else self.strata - 1
+        return self.tables[min(level, self.strata - 1)], h.to_bytes(8, 'little')
+
+    def add(self, data):
+        table, key = self._locate(data)
+        table.insert(key, b'')
+
+    def remove(self, data):
+        table, key = self._locate(data)
+        table.delete(key, b'')
+
+    def compatible(self, other):
+        """两个估计器的层数及每层 IBLT 的参数（单元数、哈希函数数量、键长）是否一致。"""
+        return self.strata == other.strata and all(
+            (a.size, a.hash_function_count, a.key_size) == (b.size, b.hash_function_count, b.key_size)
+            for a, b in zip(self.tables, other.tables))
+
+    def estimate(self, other):
+        """估计与另一个估计器之间的对称差大小，参数不一致时抛出 ValueError。"""
+        if not self.compatible(other):
+            raise ValueError("分层估计器参数不一致，无法比较")
+        count = 0
+        for level in reversed(range(self.strata)):
+            try:
+                negative, positive = (self.tables[level] ^ other.tables[level]).list_entries()
+            except ValueError:
+                return count * 2 ** (level + 1)
+            count += len(negative) + len(positive)
+        return count
+
+    def serialize(self):
+        parts = [STRATA_HEADER.pack(STRATA_MAGIC, 1, self.strata)]
+        parts.extend(table.serialize() for table in self.tables)
+        return b''.join(parts)
+
+    @classmethod
+    def from_serialized(cls, data):
+        view = memoryview(data)
+        magic, version, strata = STRATA_HEADER.unpack_from(view)
+        if magic != STRATA_MAGIC or version != 1:
+            raise ValueError("不是有效的分层估计器数据")
+        estimator = cls.__new__(cls)
+        estimator.strata = strata
+        estimator.tables = []
+        offset = STRATA_HEADER.size
+        for _ in range(strata):
+            table = IBLT.from_serialized(view[offset:])
+            estimator.tables.append(table)
+            offset += table.nbytes()
+        return estimator
+
+def estimate_coded_symbols(estimated_diff):
+    """按差异估计给出首批编码符号数：无率 IBLT 约需 1.35 倍差异，小差异时开销比例更高，留出余量。"""
+    return int(math.ceil(estimated_diff * 1.6)) + 8
+
+def estimate_iblt_size(estimated_diff, hash_function_count=3):
+    """按差异估计给出经典 IBLT 的单元数（约 2 倍差异），向上取到哈希函数数量的整数倍。"""
+    size = max(hash_function_count, int(math.ceil(estimated_diff * 2)) + 2 * hash_function_count)
+    return -(-size // hash_function_count) * hash_function_count
+
 class IBLTManager:
-    def __init__(self, context_dict, iblt_size=100, hash_function_count=3):
+    def __init__(self, context_dict, iblt_size=100, hash_function_count=3, key_size=64):
         """
         初始化IBLTManager。
         :param context_dict: 当前的上下文，一个键值对字典。
         :param iblt_size: IBLT的大小。
         :param hash_function_count: IBLT使用的哈希函数数量。
+        :param key_size: 键（UTF-8编码后）的最大字节数，超出时 IBLT 会抛出 ValueError。
         """
         self.context = context_dict
         self.iblt_size = iblt_size
         self.hash_function_count = hash_function_count
+        self.key_size = key_size
         self.iblt = self._create_iblt_from_context()
 
     def _create_iblt_from_context(self):
         """从当前上下文字典创建一个IBLT。"""
-        iblt = IBLT(self.iblt_size, self.hash_function_count)
+        iblt = IBLT(self.iblt_size, self.hash_function_count, self.key_size)
+        items = []
         for key, value in self.context.items():
             # IBLT要求key和value都是bytes
             key_bytes = str(key).encode('utf-8')
+            # 与 context_item_symbol 一致：bytes 值先按 UTF-8 解码，b"x" 与 "x" 视为同一个值
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
             value_bytes = json.dumps(value).encode('utf-8')
-            iblt.insert(key_bytes, value_bytes)
+            items.append((key_bytes, value_bytes))
+        iblt.insert_many(items)
         return iblt
 
     def encode_context(self):
@@ -289,21 +1502,26 @@ class IBLTManager:
         return self.iblt.serialize()
 
     @staticmethod
-    def decode_difference(local_context, authoritative_iblt_bytes, iblt_size=100, hash_function_count=3):
+    def decode_difference(local_context, authoritative_iblt_bytes, iblt_size=None, hash_function_count=None, key_size=None):
         """
         比较本地上下文和权威IBLT，解码出差异。
         :param local_context: 本地智能体的上下文字典。
         :param authoritative_iblt_bytes: 从meta端接收到的序列化IBLT。
-        :param iblt_size: IBLT的大小（必须与meta端一致）。
-        :param hash_function_count: 哈希函数数量（必须与meta端一致）。
+        :param iblt_size: IBLT的大小，None 表示沿用权威IBLT数据头中记录的值，给出时必须与之一致。
+        :param hash_function_count: 哈希函数数量，None 表示沿用数据头中记录的值，给出时必须与之一致。
+        :param key_size: 键的最大字节数，None 表示沿用数据头中记录的值，给出时必须与之一致。
         :return: 一个包含新增、更新和删除的键的元组 (added_keys, updated_keys, removed_keys)。
         """
-        # 1. 创建本地IBLT
-        local_iblt_manager = IBLTManager(local_context, iblt_size, hash_function_count)
-        local_iblt = local_iblt_manager.iblt
-
-        # 2. 加载权威IBLT
+        # 1. 加载权威IBLT
         authoritative_iblt = IBLT.from_serialized(authoritative_iblt_bytes, iblt_size, hash_function_count)
+        if key_size is None:
+            key_size = authoritative_iblt.key_size
+        elif key_size != authoritative_iblt.key_size:
+            raise ValueError(f"IBLT参数不一致: 数据为 key_size={authoritative_iblt.key_size}")
+
+        # 2. 以相同参数创建本地IBLT
+        local_iblt_manager = IBLTManager(local_context, authoritative_iblt.size, authoritative_iblt.hash_function_count, key_size)
+        local_iblt = local_iblt_manager.iblt
 
         # 3. 计算差异 (XOR操作)
         diff_iblt = local_iblt ^ authoritative_iblt
@@ -313,7 +1531,9 @@ class IBLTManager:
 
         added_keys = []
         updated_keys = []
-        removed_keys = [key.decode('utf-8') for key, _ in removed_items]
+        # 更新的键在两侧都会出现，只在本地一侧出现的才是删除
+        changed_keys = {key for key, _ in added_or_updated_items}
+        removed_keys = [key.decode('utf-8') for key, _ in removed_items if key not in changed_keys]
 
         for key_bytes, value_bytes in added_or_updated_items:
             key = key_bytes.decode('utf-8')
@@ -7,7 +7,9 @@ import re
 from nats.aio.client import Client as NATS
 from nats.js.api import StreamConfig
 from communication import agent_registry_listener, result_listener, publish_subtask, get_task_result_channel
-from agent import RoutingAgent, Routing
+from agent import RoutingAgent, Routing, init_routing_model
+from agent_pool import AgentPool
+from decomposition_cache import DecompositionCache
 import logging
 
 parent_dir = os.path.dirname(os.path.abspath(__file__))
@@ -32,6 +34,11 @@ RAW_TASKS = [
 # 可用能力
 ABILITIES = ["text generation", "mathematical reasoning", "grammar polish", "analysis and summary"]
 
+# 同时进行的任务拆解（LLM调用）数上限
+DECOMPOSE_CONCURRENCY = 8
+# 拆解结果缓存文件，相同/模板化的任务直接复用已有拆解
+DECOMPOSITION_CACHE_PATH = os.path.join(parent_dir, "decomposition_cache.sqlite3")
+
 # 构造任务拆解prompt
 def build_split_prompt(task_content, abilities):
     return f'''
@@ -48,12 +55,24 @@ Following are the available workers, given in the format <ability>
 You must return the subtasks in the format of a numbered list within <tasks> tags, as
 shown below:
 <tasks>
-<task>Subtask 1</task><ability>one of text generation,grammar polish,mathematical reasoning and analysis and summary</ability>
-<task>Subtask 2</task><ability>one of text generation,grammar polish,mathematical reasoning and analysis and summary</ability>
+<task>Subtask 1</task><ability>one of text generation,grammar polish,mathematical reasoning and analysis and summary</ability><depends></depends>
+<task>Subtask 2</task><ability>one of text generation,grammar polish,mathematical reasoning and analysis and summary</ability><depends>1</depends>
 </tasks>
+The <depends> tag lists the numbers of the earlier subtasks whose results this subtask
+needs, separated by commas. Leave it empty if the subtask does not need the result of
+any other subtask, so that independent subtasks can be processed in parallel.
 '''
 
-# 解析<tasks>...</tasks>格式，返回[(子任务内容, 能力)]
+# 补全/校验子任务依赖：缺省依赖上一个子任务（与原pipeline一致），只保留指向更早子任务的依赖，保证无环
+def normalize_dependencies(subtasks):
+    for i, subtask in enumerate(subtasks):
+        depends = subtask.get("depends")
+        if depends is None:
+            depends = [i - 1] if i > 0 else []
+        subtask["depends"] = sorted({d for d in depends if 0 <= d < i})
+    return subtasks
+
+# 解析<tasks>...</tasks>格式，返回[{task, ability, depends}]，depends为所依赖子任务的下标（从0开始）
 def parse_tasks(xml_str):
     xml_str=str(xml_str)
     tasks = []
@@ -61,10 +80,45 @@ def parse_tasks(xml_str):
     if not m:
         return []
     inner = m.group(1)
-    task_items = re.findall(r'<task>(.*?)</task>\s*<ability>(.*?)</ability>', inner, re.DOTALL)
-    for t, a in task_items:
-        tasks.append({"task": t.strip(), "ability": a.strip()})
-    return tasks
+    task_items = re.findall(r'<task>(.*?)</task>\s*<ability>(.*?)</ability>(\s*<depends>(.*?)</depends>)?', inner, re.DOTALL)
+    for t, a, has_depends, d in task_items:
+        # <depends>中的编号从1开始
+        depends = [int(n) - 1 for n in re.findall(r'\d+', d)] if has_depends else None
+        tasks.append({"task": t.strip(), "ability": a.strip(), "depends": depends})
+    return normalize_dependencies(tasks)
+
+# 任务的调度状态：每个子任务 pending -> running -> done，结果按子任务下标存放
+def new_task(task_id, subtasks):
+    return {"id": task_id, "subtasks": subtasks, "results": [None] * len(subtasks), "status": ["pending"] * len(subtasks),
+            "remaining": len(subtasks), "finished": False}
+
+# 拆解单个任务：先查缓存，未命中时阻塞的LLM调用放到线程中执行，semaphore限制并发数
+async def decompose_task(raw_task, semaphore, cache=None):
+    subtasks = cache.get(raw_task["content"], ABILITIES) if cache is not None else None
+    if subtasks is not None:
+        print(f"[拆解] 任务{raw_task['id']}命中拆解缓存: {subtasks}")
+        logging.info(f"[拆解] 任务{raw_task['id']}命中拆解缓存: {subtasks}")
+        return new_task(raw_task["id"], normalize_dependencies(subtasks))
+    async with semaphore:
+        # 每个任务一个agent（agent带有记忆），模型配置只初始化一次
+        agent = RoutingAgent(OPENAI_API_KEY)
+        prompt = build_split_prompt(raw_task["content"], ABILITIES)
+        try:
+            split_result = await asyncio.to_thread(Routing, prompt, agent)
+        except Exception as e:
+            print(f"[拆解] 任务{raw_task['id']}调用模型异常: {e}")
+            logging.error(f"[拆解] 任务{raw_task['id']}调用模型异常: {e}")
+            split_result = ""
+    subtasks = parse_tasks(split_result)
+    if subtasks and cache is not None:
+        cache.put(raw_task["content"], ABILITIES, subtasks)
+    if not subtasks:
+        print(f"[拆解] 任务{raw_task['id']}拆解失败，使用默认pipeline")
+        logging.warning(f"[拆解] 任务{raw_task['id']}拆解失败，使用默认pipeline")
+        subtasks = [{"task": raw_task["content"], "ability": "text generation", "depends": []}]
+    print(f"[拆解] 任务{raw_task['id']}拆解结果: {subtasks}")
+    logging.info(f"[拆解] 任务{raw_task['id']}拆解结果: {subtasks}")
+    return new_task(raw_task["id"], subtasks)
 
 async def main():
     # 初始化NATS/JetStream
@@ -75,59 +129,62 @@ async def main():
         await js.add_stream(name="META_REGISTER", subjects=["meta.register"])
     except Exception:
         pass
-    agent_registry = {}
-    capability_queues = {}
-    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_registry, capability_queues, js), durable="META_REG_DURABLE")
-    # 拆解所有任务
+    agent_pool = AgentPool()
+    # 在途子任务：agent_id -> (任务id, 子任务下标)，结果监听据此定位结果所属的子任务
+    inflight = {}
+    # 调度事件：有agent注册/复位或阶段推进时由监听器置位，主循环据此立即分配，不再定时轮询
+    dispatch_event = asyncio.Event()
+    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_pool, js, dispatch_event), durable="META_REG_DURABLE")
     TASKS = []
     logging.basicConfig(filename='metaagent.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
-    for raw_task in RAW_TASKS:
-        # 初始化agent
-        agent = RoutingAgent(OPENAI_API_KEY)
-        prompt = build_split_prompt(raw_task["content"], ABILITIES)
-        split_result = Routing(prompt, agent)
-        subtasks = parse_tasks(split_result)
-        if not subtasks:
-            print(f"[拆解] 任务{raw_task['id']}拆解失败，使用默认pipeline")
-            logging.warning(f"[拆解] 任务{raw_task['id']}拆解失败，使用默认pipeline")
-            subtasks = [{"task": raw_task["content"], "ability": "text generation"}]
-        TASKS.append({"id": raw_task["id"], "subtasks": subtasks, "results": [], "current_stage": 0, "finished": False})
-        print(f"[拆解] 任务{raw_task['id']}拆解结果: {subtasks}")
-        logging.info(f"[拆解] 任务{raw_task['id']}拆解结果: {subtasks}")
     # 结果收集
     result_dict = {}
     result_subs = []
-    for task in TASKS:
+    # 并发拆解所有任务，每个任务拆完即订阅结果并交给调度器，不必等全部拆完
+    init_routing_model(OPENAI_API_KEY)
+    semaphore = asyncio.Semaphore(DECOMPOSE_CONCURRENCY)
+    decomposition_cache = DecompositionCache(DECOMPOSITION_CACHE_PATH)
+
+    async def decompose_and_enqueue(raw_task):
+        task = await decompose_task(raw_task, semaphore, decomposition_cache)
         ch = get_task_result_channel(task['id'])  # 保证与子智能体一致
         try:
             await js.add_stream(name=f"TASK_{task['id']}_RESULT", subjects=[ch])
         except Exception:
             pass
-        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_registry), durable=f"TASK_{task['id']}_DURABLE")
+        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_pool, inflight, dispatch_event), durable=f"TASK_{task['id']}_DURABLE")
         result_subs.append(sub)
+        TASKS.append(task)
+
+    decompose_jobs = [asyncio.ensure_future(decompose_and_enqueue(raw_task)) for raw_task in RAW_TASKS]
+    for job in decompose_jobs:
+        # 拆解完成（或失败）都唤醒调度器
+        job.add_done_callback(lambda _: dispatch_event.set())
     print("[主控] 启动主循环...")
     logging.info("[主控] 启动主循环...")
-    while not all([t["finished"] for t in TASKS]):
-        await asyncio.sleep(0.2)
+    dispatch_event.set()
+    while not all(job.done() for job in decompose_jobs) or not all([t["finished"] for t in TASKS]):
+        # 先清除再扫描：扫描期间（await发布时）到达的事件会保留到下一轮
+        await dispatch_event.wait()
+        dispatch_event.clear()
         for task in TASKS:
             if task["finished"]:
                 continue
-            stage = task["current_stage"]
-            if stage >= len(task["subtasks"]):
-                continue
-            subtask = task["subtasks"][stage]
-            required_cap = subtask["ability"]
-            agent_id = None
-            for aid in capability_queues.get(required_cap, []):
-                agent_info = agent_registry.get(aid, {})
-                if agent_info.get("status") == "idle":
-                    agent_id = aid
-                    break
-            if agent_id:
-                agent_registry[agent_id]["status"] = "busy"
-                listen_channel = agent_registry[agent_id]["listen_channel"]
+            # 依赖全部完成的子任务都可以立即分发，互不依赖的子任务并行执行
+            for idx, subtask in enumerate(task["subtasks"]):
+                if task["status"][idx] != "pending" or any(task["status"][d] != "done" for d in subtask["depends"]):
+                    continue
+                required_cap = subtask["ability"]
+                # 按能力取空闲最久的agent，O(1)且轮流分配
+                agent_id = agent_pool.acquire(required_cap)
+                if not agent_id:
+                    continue
+                task["status"][idx] = "running"
+                inflight[agent_id] = (task["id"], idx)
+                listen_channel = agent_pool.get(agent_id)["listen_channel"]
                 overall_task = RAW_TASKS[task["id"]-1]["content"] if task["id"]-1 < len(RAW_TASKS) else ""
-                dependency_results = "" if stage == 0 else "\n".join(task["results"])
+                # 只附带实际依赖的子任务结果
+                dependency_results = "\n".join(task["results"][d] for d in subtask["depends"])
                 additional_info = "None"
                 query = f"""
 We are solving a complex task, and we have split the task into several subtasks.
@@ -156,15 +213,22 @@ may be empty):
 Now please fully leverage the information above, try your best to leverage
 the existing results and your available tools to solve the current task.
 """
-                print(f"[分发] 任务{task['id']} 阶段{stage} 分配给{agent_id}，内容: {subtask['task']}")
-                logging.info(f"[分发] 任务{task['id']} 阶段{stage} 分配给{agent_id}，内容: {subtask['task']}")
-                await publish_subtask(js, listen_channel, task["id"], query)
+                print(f"[分发] 任务{task['id']} 子任务{idx} 分配给{agent_id}，内容: {subtask['task']}")
+                logging.info(f"[分发] 任务{task['id']} 子任务{idx} 分配给{agent_id}，内容: {subtask['task']}")
+                await publish_subtask(js, listen_channel, task["id"], query, idx)
     print("[主控] 所有任务已完成！")
     logging.info("[主控] 所有任务已完成！")
     # ... existing code ...
     print("[主控] 所有任务已完成！")
     logging.info("[主控] 所有任务已完成！")
-    # 保存所有任务的原始提问和最终结果到jsonl文件
+    for job in decompose_jobs:
+        if job.exception() is not None:
+            print(f"[拆解] 任务入队异常: {job.exception()}")
+            logging.error(f"[拆解] 任务入队异常: {job.exception()}")
+    decomposition_cache.log_stats()
+    decomposition_cache.close()
+    # 保存所有任务的原始提问和最终结果到jsonl文件（拆解完成顺序不定，按任务id排序）
+    TASKS.sort(key=lambda t: t["id"])
     with open("results.jsonl", "w", encoding="utf-8") as f:
         for task in TASKS:
             record = {
@@ -183,7 +247,7 @@ the existing results and your available tools to solve the current task.
             "time": time.time()
         }
     }
-    for agent_id, info in agent_registry.items():
+    for agent_id, info in agent_pool.items():
         listen_channel = info["listen_channel"]
         await js.publish(listen_channel, json.dumps(shutdown_msg).encode())
         print(f"[主控] 已向 {agent_id} ({listen_channel}) 发送 shutdown")
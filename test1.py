@@ -6,22 +6,42 @@ import json
 import re
 from nats.aio.client import Client as NATS
 from nats.js.api import StreamConfig
-from communication1 import agent_registry_listener, result_listener, publish_subtask, get_task_result_channel
+from communication1 import agent_registry_listener, result_listener, publish_subtask, get_task_result_channel, base_vnodes
 from agent import RoutingAgent, Routing
 import logging
-from consistent_hash import ConsistentHashing
-from cuckoopy import CuckooFilter
+from consistent_hash import ConsistentHashing, RING_TYPES, ThroughputTracker
+from agent_pool import AgentStateTable
 
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 dotenv.load_dotenv(os.path.join(parent_dir, ".env"))
 IP = os.getenv("IP")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# 初始化Cuckoo Filter
-busy_agent_sketch = CuckooFilter(capacity=1000, bucket_size=4, fingerprint_size=1)
+# agent忙/闲状态表（精确，无假阳性）
+agent_states = AgentStateTable()
 
 # 初始化一致性哈希环
 capability_rings = {}
+# 各能力使用的路由结构："ring"（虚拟节点环）、"jump"、"rendezvous"，未列出的用 "ring"
+# 成员很少变化的能力池适合 jump/rendezvous：无虚拟节点，负载更均匀
+CAPABILITY_RING_TYPES = {}
+
+def make_ring(capability):
+    return RING_TYPES[CAPABILITY_RING_TYPES.get(capability, "ring")]()
+
+# 按实测吞吐定期调整各agent在环上的权重，快的agent分到更多子任务
+throughput_tracker = ThroughputTracker()
+REWEIGHT_INTERVAL = 10
+
+async def reweight_loop(agent_registry):
+    while True:
+        await asyncio.sleep(REWEIGHT_INTERVAL)
+        for capability, ring in capability_rings.items():
+            changes = throughput_tracker.rebalance(
+                ring, lambda aid: base_vnodes(agent_registry[aid]["capabilities"]) if aid in agent_registry else base_vnodes([]))
+            if changes:
+                print(f"[权重] 能力'{capability}' 虚拟节点调整: {changes}")
+                logging.info(f"[权重] 能力'{capability}' 虚拟节点调整: {changes}")
 
 # 任务队列示例
 RAW_TASKS = [
@@ -80,15 +100,15 @@ def select_agent(capability, task_id, agent_registry):
         print(f"[调度] 能力'{capability}'不存在哈希环")
         return None
 
+    # 该能力下没有空闲agent时直接返回，不必走环
+    if agent_states.any_idle(capability) is None:
+        return None
     ring = capability_rings[capability]
-    # 尝试最多len(agent_registry)次，避免死循环
-    for _ in range(len(agent_registry)):
-        agent_id = ring.get_node(str(task_id))
-        if agent_id and not busy_agent_sketch.contains(agent_id):
-            return agent_id
-        # 如果agent忙碌，则尝试下一个节点
-        task_id += 1
-    return None
+    # 有界负载：从任务的哈希位置顺时针找第一个未超容量且不忙的agent，最多走一圈
+    agent_id = ring.get_node_bounded(str(task_id), exclude=agent_states.is_busy)
+    if agent_id:
+        ring.acquire(agent_id)
+    return agent_id
 
 async def main():
     # 初始化NATS/JetStream
@@ -101,7 +121,9 @@ async def main():
         pass
     agent_registry = {}
     capability_queues = {}
-    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_registry, capability_rings, js), durable="META_REG_DURABLE")
+    # 调度事件：有agent注册/复位或收到结果时由监听器置位，主循环据此立即分配，不再定时轮询
+    dispatch_event = asyncio.Event()
+    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_registry, capability_rings, js, dispatch_event, agent_states, make_ring, throughput_tracker), durable="META_REG_DURABLE")
     
     # 拆解所有任务
     TASKS = []
@@ -128,11 +150,16 @@ async def main():
             await js.add_stream(name=f"TASK_{task['id']}_RESULT", subjects=[ch])
         except Exception:
             pass
-        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_registry, busy_agent_sketch), durable=f"TASK_{task['id']}_DURABLE")
+        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_registry, agent_states, dispatch_event, capability_rings, throughput_tracker), durable=f"TASK_{task['id']}_DURABLE")
         result_subs.append(sub)
     print("[主控] 启动主循环...")
     logging.info("[主控] 启动主循环...")
+    reweight_job = asyncio.ensure_future(reweight_loop(agent_registry))
+    dispatch_event.set()
     while not all([t["finished"] for t in TASKS]):
+        # 先清除再扫描：扫描期间（await发布时）到达的事件会保留到下一轮
+        await dispatch_event.wait()
+        dispatch_event.clear()
         for task in TASKS:
             if not task["finished"] and task["current_stage"] < len(task["subtasks"]):
                 subtask = task["subtasks"][task["current_stage"]]
@@ -141,16 +168,19 @@ async def main():
                 if agent_id:
                     agent_info = agent_registry[agent_id]
                     # 更新agent状态为busy
-                    busy_agent_sketch.insert(agent_id)
+                    agent_states.mark_busy(agent_id)
+                    throughput_tracker.on_dispatch(agent_id)
                     print(f"[调度] 任务{task['id']}阶段{task['current_stage']}->{agent_id}({capability}) {agent_info['listen_channel']}")
                     logging.info(f"[调度] 任务{task['id']}阶段{task['current_stage']}->{agent_id}({capability}) {agent_info['listen_channel']}")
                     await publish_subtask(js, agent_info["listen_channel"], task["id"], subtask["task"])
                     task["current_stage"] += 1  # 假定立即发送成功
+                    # 下一阶段随即就绪，再扫描一轮
+                    dispatch_event.set()
                 else:
                     print(f"[调度] 任务{task['id']}阶段{task['current_stage']} 无可用agent({capability})")
                     logging.info(f"[调度] 任务{task['id']}阶段{task['current_stage']} 无可用agent({capability})")
-        await asyncio.sleep(1)
     # 清理
+    reweight_job.cancel()
     await reg_sub.unsubscribe()
     for sub in result_subs:
         await sub.unsubscribe()
@@ -6,20 +6,20 @@ import json
 import re
 from nats.aio.client import Client as NATS
 from nats.js.api import StreamConfig
-from communication2 import agent_registry_listener, result_listener, publish_subtask, get_task_result_channel
+from communication2 import agent_registry_listener, result_listener, publish_subtask, get_task_result_channel, iblt_more_listener, publish_shared_stream, IBLT_MORE_CHANNEL, IBLT_STREAM_NAME, IBLT_STREAM_SUBJECTS
 from agent import RoutingAgent, Routing
 import logging
 from consistent_hash import ConsistentHashing
-from cuckoopy import CuckooFilter
-from iblt import RatelessIBLTManager # 导入 IBLT 相关模块
+from agent_pool import AgentStateTable
+from iblt import RatelessIBLTManager, estimate_coded_symbols # 导入 IBLT 相关模块
 
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 dotenv.load_dotenv(os.path.join(parent_dir, ".env"))
 IP = os.getenv("IP")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# 初始化Cuckoo Filter
-busy_agent_sketch = CuckooFilter(capacity=1000, bucket_size=4, fingerprint_size=1)
+# agent忙/闲状态表（精确，无假阳性）
+agent_states = AgentStateTable()
 
 # 初始化一致性哈希环
 capability_rings = {}
@@ -81,11 +81,14 @@ def select_agent(capability, task_id, agent_registry):
         print(f"[调度] 能力'{capability}'不存在哈希环")
         return None
 
+    # 该能力下没有空闲agent时直接返回，不必探测
+    if agent_states.any_idle(capability) is None:
+        return None
     ring = capability_rings[capability]
     # 尝试最多len(agent_registry)次，避免死循环
     for _ in range(len(agent_registry)):
         agent_id = ring.get_node(str(task_id))
-        if agent_id and not busy_agent_sketch.contains(agent_id):
+        if agent_id and not agent_states.is_busy(agent_id):
             return agent_id
         # 如果agent忙碌，则尝试下一个节点
         task_id += 1
@@ -107,6 +110,13 @@ async def main():
             f"doc_{i}_1": f"This is the first document for task {i}.".encode('utf-8'),
             f"doc_{i}_2": f"This is the second document for task {i}.".encode('utf-8')
         }
+        # 每个任务上下文保留一个编码会话，子智能体解码失败时可以继续拉取
+        iblt_manager.open_session(i, TASK_CONTEXTS[i])
+    more_sub = await nc.subscribe(IBLT_MORE_CHANNEL, cb=iblt_more_listener(iblt_manager, js=js))
+    try:
+        await js.add_stream(name=IBLT_STREAM_NAME, subjects=[IBLT_STREAM_SUBJECTS])
+    except Exception:
+        pass
 
     try:
         await js.add_stream(name="META_REGISTER", subjects=["meta.register"])
@@ -114,7 +124,9 @@ async def main():
         pass
     agent_registry = {}
     capability_queues = {}
-    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_registry, capability_rings, js), durable="META_REG_DURABLE")
+    # 调度事件：有agent注册/复位或收到结果时由监听器置位，主循环据此立即分配，不再定时轮询
+    dispatch_event = asyncio.Event()
+    reg_sub = await js.subscribe("meta.register", cb=agent_registry_listener(agent_registry, capability_rings, js, dispatch_event, agent_states), durable="META_REG_DURABLE")
     
     # 拆解所有任务
     TASKS = []
@@ -141,11 +153,15 @@ async def main():
             await js.add_stream(name=f"TASK_{task['id']}_RESULT", subjects=[ch])
         except Exception:
             pass
-        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_registry, busy_agent_sketch), durable=f"TASK_{task['id']}_DURABLE")
+        sub = await js.subscribe(ch, cb=result_listener(result_dict, js, [task["id"]], TASKS, agent_registry, agent_states, dispatch_event), durable=f"TASK_{task['id']}_DURABLE")
         result_subs.append(sub)
     print("[主控] 启动主循环...")
     logging.info("[主控] 启动主循环...")
+    dispatch_event.set()
     while not all([t["finished"] for t in TASKS]):
+        # 先清除再扫描：扫描期间（await发布时）到达的事件会保留到下一轮
+        await dispatch_event.wait()
+        dispatch_event.clear()
         for task in TASKS:
             if not task["finished"] and task["current_stage"] < len(task["subtasks"]):
                 subtask = task["subtasks"][task["current_stage"]]
@@ -154,27 +170,36 @@ async def main():
                 if agent_id:
                     agent_info = agent_registry[agent_id]
                     # 更新agent状态为busy
-                    busy_agent_sketch.insert(agent_id)
+                    agent_states.mark_busy(agent_id)
 
                     # --- IBLT 集成开始 ---
-                    # 1. 获取当前任务的权威上下文
-                    authoritative_context = TASK_CONTEXTS.get(task['id'], {})
-
-                    # 2. 将上下文编码为 IBLT
-                    iblt_serialized = iblt_manager.encode(authoritative_context)
+                    # 1. 将任务的编码会话与权威上下文对齐（只增量处理变化的键）
+                    session = iblt_manager.sync_session(task['id'], TASK_CONTEXTS.get(task['id'], {}))
+
+                    # 2. 确保共享流上已有足够的编码符号前缀，不够时由子智能体请求续发；
+                    #    子智能体公布了分层估计器时按估计的差异大小决定首批数量，
+                    #    同一上下文版本的多次分发共用一条流，只补发超出已发布部分的批次
+                    if agent_info.get("strata") is not None:
+                        estimated_diff = iblt_manager.estimate_difference(task['id'], agent_info["strata"])
+                        initial_count = estimate_coded_symbols(estimated_diff)
+                    else:
+                        initial_count = max(1, int(len(session) * 1.5))
+                    iblt_subject = await publish_shared_stream(js, iblt_manager, task['id'], initial_count)
                     # --- IBLT 集成结束 ---
 
                     print(f"[调度] 任务{task['id']}阶段{task['current_stage']}->{agent_id}({capability}) {agent_info['listen_channel']}")
                     logging.info(f"[调度] 任务{task['id']}阶段{task['current_stage']}->{agent_id}({capability}) {agent_info['listen_channel']}")
-                    # 3. 发布任务，并附带 IBLT
-                    await publish_subtask(js, agent_info["listen_channel"], task["id"], subtask["task"], iblt_serialized.encode('utf-8'))
+                    # 3. 发布任务，并附带共享流主题
+                    await publish_subtask(js, agent_info["listen_channel"], task["id"], subtask["task"], iblt_context=task["id"], iblt_version=session.version, iblt_subject=iblt_subject)
                     task["current_stage"] += 1  # 假定立即发送成功
+                    # 下一阶段随即就绪，再扫描一轮
+                    dispatch_event.set()
                 else:
                     print(f"[调度] 任务{task['id']}阶段{task['current_stage']} 无可用agent({capability})")
                     logging.info(f"[调度] 任务{task['id']}阶段{task['current_stage']} 无可用agent({capability})")
-        await asyncio.sleep(1)
     # 清理
     await reg_sub.unsubscribe()
+    await more_sub.unsubscribe()
     for sub in result_subs:
         await sub.unsubscribe()
     await nc.close()